@@ -1,5 +1,10 @@
+import argparse
+import json
 import sqlite3
 
+import db
+import migrations
+
 
 def insert_notification(title, body, key, status=0):
     try:
@@ -56,15 +61,125 @@ def get_all_keys():
         return []
 
 
-if __name__ == '__main__':
-    title, body = get_user_input()
-    keys = get_all_keys()
+def broadcast(title, body, keys=None, cursor=None):
+    # Fan a notification out to every login key, or to ``keys`` only, in a
+    # single transaction. Returns the number of notifications created.
+    if cursor is None:
+        conn = db.open_connection(db.NOTIFICATION_DB)
+        try:
+            with conn:
+                return broadcast(title, body, keys, conn.cursor())
+        finally:
+            conn.close()
+
+    if keys is None:
+        # Only keys that still work, as in verify_key; expired ones are pruned
+        cursor.execute('''
+            INSERT INTO notifications (title, body, status, key)
+            SELECT DISTINCT ?, ?, 0, key FROM login_key
+            WHERE key IS NOT NULL AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+        ''', (title, body))
+        return cursor.rowcount
+    cursor.executemany(
+        'INSERT INTO notifications (title, body, status, key) VALUES (?, ?, 0, ?)',
+        [(title, body, key) for key in dict.fromkeys(keys)])
+    return len(dict.fromkeys(keys))
+
+
+def schedule(title, body, deliver_at, keys=None):
+    # Queue a broadcast; deliver_due() sends it once deliver_at has passed
+    conn = db.open_connection(db.NOTIFICATION_DB)
+    try:
+        with conn:
+            conn.execute(
+                'INSERT INTO scheduled_notifications (title, body, keys, deliver_at) VALUES (?, ?, ?, ?)',
+                (title, body, None if keys is None else json.dumps(list(keys)), deliver_at))
+    finally:
+        conn.close()
+
 
-    if keys:
-        for key in keys:
-            insert_notification(title, body, key)
+def any_due(cursor):
+    # Cheap check on idx_scheduled_notifications_due, so readers only take
+    # the write lock when there is something to deliver
+    cursor.execute('''
+        SELECT 1 FROM scheduled_notifications
+        WHERE delivered = 0 AND deliver_at <= CURRENT_TIMESTAMP
+        LIMIT 1
+    ''')
+    return cursor.fetchone() is not None
+
+
+def deliver_pending(cursor):
+    # Send every scheduled broadcast that is due inside the caller's write
+    # transaction, so each is sent exactly once. Returns (batches, sent).
+    cursor.execute('''
+        SELECT id, title, body, keys FROM scheduled_notifications
+        WHERE delivered = 0 AND deliver_at <= CURRENT_TIMESTAMP
+        ORDER BY deliver_at
+    ''')
+    due = cursor.fetchall()
+    sent = 0
+    for id, title, body, keys in due:
+        sent += broadcast(title, body, None if keys is None else json.loads(keys), cursor)
+        cursor.execute(
+            'UPDATE scheduled_notifications SET delivered = 1 WHERE id = ?', (id,))
+    return len(due), sent
+
+
+def deliver_due():
+    # Send every scheduled broadcast that is due, each exactly once
+    conn = db.open_connection(db.NOTIFICATION_DB)
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            return deliver_pending(cursor)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send a notification to app users')
+    parser.add_argument('--title')
+    parser.add_argument('--body')
+    parser.add_argument('--keys', help='comma-separated login keys (default: every key)')
+    parser.add_argument('--at', help="schedule for later, e.g. '2024-01-31 09:00:00' (UTC)")
+    parser.add_argument('--deliver-due', action='store_true',
+                        help='send scheduled notifications that are due and exit')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't print the notifications table afterwards")
+    args = parser.parse_args()
+
+    migrations.migrate(db.NOTIFICATION_DB)
+
+    if args.deliver_due:
+        batches, sent = deliver_due()
+        print(f"Delivered {batches} scheduled notification(s) to {sent} key(s).")
+        return
+
+    if args.title is None or args.body is None:
+        title, body = get_user_input()
     else:
-        print("No keys found.")
+        title, body = args.title, args.body
+    keys = [key.strip() for key in args.keys.split(',')] if args.keys else None
+
+    try:
+        if args.at:
+            schedule(title, body, args.at, keys)
+            print(f"Notification scheduled for {args.at}.")
+        else:
+            sent = broadcast(title, body, keys)
+            if sent:
+                print(f"Notification inserted for {sent} key(s).")
+            else:
+                print("No keys found.")
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
 
-    print("All data in 'notifications' table:")
-    print_all_data()
+    if not args.quiet:
+        print("All data in 'notifications' table:")
+        print_all_data()
+
+
+if __name__ == '__main__':
+    main()
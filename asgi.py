@@ -0,0 +1,225 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import auth
+import db
+from notify_bus import AsyncSubscription
+
+# Request bodies larger than this are spooled to a temporary file
+MAX_MEMORY_BODY = 1024 * 1024
+
+
+class ASGIApp:
+    """Runs the Flask routes under an asyncio server such as uvicorn.
+
+    Reading request bodies and sending responses happens on the event loop,
+    so thousands of slow clients cost no threads. A view only takes one of
+    ``threads`` handler threads while it runs, reading from the read-only
+    connection pools; every write is queued to the per-database writer
+    thread (``db.use_writer_threads``), which commits them in groups.
+    /notifications/stream waits on the event loop instead of in a thread.
+    """
+
+    def __init__(self, flask_app, threads):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='asgi-view')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] != 'http':
+            return
+        elif scope['path'] == '/notifications/stream' and scope['method'] == 'GET':
+            await self.notification_stream(scope, receive, send)
+        else:
+            await self.call_flask(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def read_body(self, receive):
+        body = tempfile.SpooledTemporaryFile(MAX_MEMORY_BODY)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                body.seek(0)
+                return body
+
+    def environ(self, scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+            'PATH_INFO': scope['path'].encode().decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            environ[name] = environ[name] + ',' + value if name in environ else value
+        return environ
+
+    def start_flask(self, environ, response):
+        # Runs the view; fills ``response`` with status, headers, the body
+        # iterable and its first chunk
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+
+        response['iterable'] = self.flask_app(environ, start_response)
+        response['iterator'] = iter(response['iterable'])
+        response['chunk'] = next(response['iterator'], None)
+
+    async def call_flask(self, scope, receive, send):
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        response = {}
+        try:
+            await self.run(self.start_flask, self.environ(scope, body), response)
+            await send({
+                'type': 'http.response.start',
+                'status': response['status'],
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in response['headers']],
+            })
+            # Streamed responses fetch each chunk in a handler thread
+            chunk = response['chunk']
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await self.run(next, response['iterator'], None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(response.get('iterable'), 'close'):
+                await self.run(response['iterable'].close)
+            body.close()
+
+    async def send_json(self, send, data, status=200):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json')],
+        })
+        await send({'type': 'http.response.body', 'body': json.dumps(data).encode()})
+
+    async def notification_stream(self, scope, receive, send):
+        # Same behaviour as auth.notification_stream, waiting on the event loop
+        args = parse_qs(scope['query_string'].decode('latin-1'))
+        key = args.get('key', [None])[0]
+        if not await self.run(auth.verify_key, key):
+            await self.send_json(send, {'message': 'Not Authenticated'}, 401)
+            return
+
+        subscription = auth.notification_bus.subscribe(key, AsyncSubscription)
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            try:
+                await self.run(auth.deliver_scheduled)
+                pending = await self.run(auth.unread_notifications, key)
+            except sqlite3.Error as e:
+                logging.error(f"SQLite error: {e}")
+                await self.send_json(send, {'message': 'Failed to fetch notifications'}, 500)
+                return
+
+            accept = dict(scope['headers']).get(b'accept', b'').decode('latin-1')
+            if parse_accept_header(accept, MIMEAccept).best == 'text/event-stream':
+                await self.send_events(send, key, subscription, pending, disconnected)
+                return
+
+            timeout = auth.long_poll_timeout(args.get('timeout', [auth.LONG_POLL_TIMEOUT])[0])
+            rows = pending or await wait_for_rows(subscription, timeout, disconnected)
+            if rows is None:
+                return
+            if not rows:
+                await self.send_json(send, {'message': 'No notifications found'}, 404)
+                return
+
+            await self.run(auth.mark_notifications_read, key, [row[0] for row in rows])
+            await self.send_json(send, [{'id': id, 'title': title, 'body': body} for id, title, body in rows])
+        finally:
+            disconnected.cancel()
+            auth.notification_bus.unsubscribe(subscription)
+
+    async def send_events(self, send, key, subscription, rows, disconnected):
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                        (b'cache-control', b'no-cache')],
+        })
+        last_id = 0
+        while rows is not None:
+            rows = [row for row in rows if row[0] > last_id]
+            if rows:
+                await self.run(auth.mark_notifications_read, key, [row[0] for row in rows])
+                last_id = rows[-1][0]
+                chunk = ''.join(auth.sse_event(*row) for row in rows)
+            else:
+                chunk = ': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+            rows = await wait_for_rows(subscription, auth.SSE_KEEPALIVE, disconnected)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def wait_for_rows(subscription, timeout, disconnected):
+    # Returns the new rows, [] on timeout or None once the client has gone
+    get = asyncio.ensure_future(subscription.get(timeout))
+    await asyncio.wait({get, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+    if not get.done():
+        get.cancel()
+        return None
+    return get.result()
+
+
+def create_app(config=None):
+    flask_app = auth.create_app(config)
+    # From here on reads use read-only connections and writes are queued
+    db.use_writer_threads()
+    return ASGIApp(flask_app, int(flask_app.config['ASGI_THREADS']))
+
+
+# ASGI entry point, e.g.
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000
+# Run a single process: the writer thread only serializes writes within it.
+app = create_app(auth.config_from_env())
@@ -1,35 +1,162 @@
-from datetime import date
+import add_notify
+import csv
+from datetime import date, timedelta
+import functools
+import itertools
+import json
 import logging
-from flask import Flask, jsonify, request
+import math
+import os
+import time
+from flask import Blueprint, Flask, Response, current_app, g, jsonify, make_response, request
 import sqlite3
-import random
-import string
-
-app = Flask(__name__)
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+import db
+import bulk
+from cache import KeyCache, ResponseCache
+import customers
+import expiry
+import ledger
+import login_keys
+import maintenance
+import metrics
+import migrations
+from notify_bus import NotificationBus
+import reports
+import scheduler
+import search
+import streaming
+import versions
+
+# All routes live on this blueprint; create_app() builds the Flask app
+api = Blueprint('api', __name__)
+
+# Defaults for create_app(); each can be overridden with an SVP_<NAME>
+# environment variable
+DEFAULT_CONFIG = {
+    'LOG_LEVEL': 'INFO',
+    # Create tables and run migrations when the app is created. Set to 0
+    # when a process manager does it once before starting workers.
+    'INIT_DB': True,
+    # Threads running views under asgi.py; slow clients do not hold one
+    # while their request or response is in transit
+    'ASGI_THREADS': 32,
+    # Time requests and SQL statements and serve them at /metrics
+    'METRICS': False,
+    # Log statements slower than this many milliseconds; 0 to disable
+    'SLOW_QUERY_MS': 0,
+    # Login keys expire this many days after login or refresh
+    'KEY_TTL_DAYS': login_keys.DEFAULT_TTL_DAYS,
+    # Run the maintenance jobs in scheduler.py in a background thread; one
+    # worker runs each job. Off by default: `python scheduler.py serve` can
+    # run them in a process of its own instead.
+    'SCHEDULER': False,
+    # Daily copies of both databases into this directory, the newest
+    # BACKUP_KEEP of each kept; empty for no backups
+    'BACKUP_DIR': '',
+    'BACKUP_KEEP': maintenance.BACKUP_KEEP,
+    # Read notifications are deleted this many days after they were sent
+    'READ_RETENTION_DAYS': login_keys.READ_RETENTION_DAYS,
+    # Notify every login key daily of stock expiring within this many days;
+    # 0 for no alert
+    'EXPIRY_ALERT_DAYS': 0,
+    # File holding the response cache's table versions, shared by all worker
+    # processes; empty to keep them in-process
+    'CACHE_VERSIONS_FILE': db.INVENTORY_DB + '-versions',
+}
 
 
 # Hardcoded valid credentials for the login endpoint
 valid_email = 'skbd@skbd.com'
 valid_password = 'skbd0001'
 
+# Cache of rendered GET responses, invalidated by per-table versions
+response_cache = ResponseCache()
+
+# Cache of API key lookups shared by every route; deleting keys bumps the
+# 'login_key' version, which every worker sees through the shared versions
+key_cache = KeyCache(version=lambda: response_cache.versions(('login_key',))[0])
+
+# Release metadata for /version-manager, kept in memory
+version_registry = versions.VersionRegistry()
+
+# Pushes new notification rows to clients waiting on /notifications/stream
+notification_bus = NotificationBus()
+
+# Request and SQL timings for /metrics, only recorded when enabled
+request_metrics = metrics.Metrics()
+
+# One scheduler thread per process, however many apps are created
+scheduler_started = False
+
 # Function to verify API key
 
 
 def verify_key(key):
-    with sqlite3.connect('login_notification_data.db') as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT 1 FROM login_key WHERE key=?', (key,))
-        return cursor.fetchone() is not None
+    if not key:
+        return False
+    valid = key_cache.get(key)
+    if valid is None:
+        with db.notifications() as conn:
+            cursor = conn.cursor()
+            cursor.execute(login_keys.SECONDS_LEFT_QUERY, (key,))
+            row = cursor.fetchone()
+        # An expiring key is only cached until it expires
+        seconds_left = row[0] if row else None
+        valid = row is not None and (seconds_left is None or seconds_left > 0)
+        key_cache.set(key, valid, seconds_left if valid else None)
+    return valid
+
+
+def revoke_keys(keys):
+    # Call after deleting login keys so no worker keeps them cached
+    key_cache.invalidate(keys)
+    response_cache.bump('login_key')
+
+
+# Serve a GET route from the response cache while the tables it reads are
+# unchanged, answering If-None-Match with 304 without touching the database
+
+
+def cached_response(*tables):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if streaming.wants_stream() or not verify_key(request.args.get('key')):
+                return view(*args, **kwargs)
+
+            # The API key does not change the response, so it is not part of the cache key
+            cache_key = (request.path, tuple(sorted(
+                (name, value) for name, value in request.args.items(multi=True) if name != 'key')))
+            # Read the versions before the query so a concurrent write is never
+            # cached under its own version
+            versions = response_cache.versions(tables)
+            entry = response_cache.get(cache_key, versions)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                entry = response_cache.put(
+                    cache_key, versions, response.get_data(), response.mimetype)
+
+            body, etag, mimetype = entry
+            if request.if_none_match.contains(etag):
+                response_cache.record_not_modified(len(body))
+                response = Response(status=304)
+            else:
+                response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
 
 
 # Function to create SQLite database and tables if they don't exist
 
 
 def create_database_and_tables():
-    with sqlite3.connect('inventory.db') as conn:
+    db.init_file(db.INVENTORY_DB)
+    db.init_file(db.NOTIFICATION_DB)
+    with db.inventory() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS items (
@@ -91,7 +218,7 @@ def create_database_and_tables():
         conn.commit()
     logging.info("SQLite database 'inventory.db' and all tables created.")
 
-    with sqlite3.connect('login_notification_data.db') as conn:
+    with db.notifications() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS login_key (
@@ -114,18 +241,12 @@ def create_database_and_tables():
 ''')
         conn.commit()
 
+    # Bring existing databases up to date (indexes and later schema changes)
+    migrations.migrate_all()
 
-# Call the function to create the database and tables
-create_database_and_tables()
 
 
-def gen_key():
-    N = 7
-    res = ''.join(random.choices(string.ascii_uppercase + string.digits, k=N))
-    return res
-
-
-@app.route('/login', methods=['POST'])
+@api.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
 
@@ -135,24 +256,50 @@ def login():
     if data['email'] != valid_email or data['password'] != valid_password or data['app'] != 'svp_admin':
         return jsonify({'message': 'Invalid email or password'}), 401
 
-    key = str(gen_key())
-    with sqlite3.connect('login_notification_data.db') as conn:
-        cursor = conn.cursor()
+    ttl_days = current_app.config['KEY_TTL_DAYS']
+    key, expires_at = db.write(db.NOTIFICATION_DB,
+                               lambda cursor: login_keys.insert_key(cursor, valid_email, ttl_days))
+    key_cache.set(key, True)
 
-        # Ensure the key is unique
-        cursor.execute('SELECT 1 FROM login_key WHERE key = ?', (key,))
-        while cursor.fetchone() is not None:
-            key = str(gen_key())
-            cursor.execute('SELECT 1 FROM login_key WHERE key = ?', (key,))
+    return jsonify({'message': 'Login successful', 'key': key, 'expires_at': expires_at}), 200
 
-        cursor.execute(
-            'INSERT INTO login_key(user, key) VALUES (?, ?)', (valid_email, key))
-        conn.commit()
 
-    return jsonify({'message': 'Login successful', 'key': key}), 200
+@api.route('/login/refresh', methods=['POST'])
+def refresh_login():
+    # Swap a valid key for a new one with a fresh expiry; the old key stops
+    # working and its notifications move to the new one
+    data = request.get_json()
+    if not data or 'key' not in data:
+        return jsonify({'message': 'key is required'}), 400
 
+    key = data['key']
+    ttl_days = current_app.config['KEY_TTL_DAYS']
+    try:
+        rotated = db.write(db.NOTIFICATION_DB, lambda cursor: login_keys.rotate_key(cursor, key, ttl_days))
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'message': 'Failed to refresh key'}), 500
+    if rotated is None:
+        key_cache.invalidate([key])
+        return jsonify({'message': 'Not Authenticated'}), 401
+    revoke_keys([key])
 
-@app.route('/add-item', methods=['POST'])
+    new_key, expires_at = rotated
+    key_cache.set(new_key, True)
+    return jsonify({'message': 'Key refreshed', 'key': new_key, 'expires_at': expires_at}), 200
+
+
+def insert_items(cursor, rows):
+    # rows are (item, quantity, batch_no, manufacture_date, expiry_date, dealer_name, price).
+    # The receipt is recorded in stock_ledger by trigger; items_data is no
+    # longer written.
+    cursor.executemany('''
+        INSERT INTO items (item, quantity, batch_no, manufacture_date, expiry_date, dealer_name, price, expiry_day)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [tuple(row) + (expiry.normalize_date(row[4]),) for row in rows])
+
+
+@api.route('/add-item', methods=['POST'])
 def add_item():
     data = request.get_json()
     required_fields = ['item', 'quantity', 'batchNo',
@@ -169,17 +316,10 @@ def add_item():
         return jsonify({'message': 'Not Authenticated'}), 401
 
     try:
-        with sqlite3.connect('inventory.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO items (item, quantity, batch_no, manufacture_date, expiry_date, dealer_name, price)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (data['item'], data['quantity'], data['batchNo'], data['manufactureDate'], data['expiryDate'], data['dealerName'], data['price']))
-            cursor.execute('''
-                INSERT INTO items_data (item, quantity, batch_no, manufacture_date, expiry_date, dealer_name, price)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (data['item'], data['quantity'], data['batchNo'], data['manufactureDate'], data['expiryDate'], data['dealerName'], data['price']))
-            conn.commit()
+        db.write(db.INVENTORY_DB, lambda cursor: insert_items(
+            cursor, [(data['item'], data['quantity'], data['batchNo'], data['manufactureDate'],
+                      data['expiryDate'], data['dealerName'], data['price'])]))
+        response_cache.bump('items')
         return jsonify({'message': 'Item added successfully', 'data': data}), 200
 
     except sqlite3.Error as e:
@@ -187,14 +327,71 @@ def add_item():
         return jsonify({'message': 'Failed to add item'}), 500
 
 
-@app.route('/dealers', methods=['GET'])
+@api.route('/add-items/bulk', methods=['POST'])
+def add_items_bulk():
+    # Accepts {"key": ..., "items": [...]} as JSON, or a CSV body / "file"
+    # upload with the key in the query string
+    if request.is_json:
+        data = request.get_json()
+        if not isinstance(data, dict) or not isinstance(data.get('items'), list):
+            return jsonify({'message': 'items must be a list'}), 400
+        key = data.get('key') or request.args.get('key')
+        rows = data['items']
+    else:
+        key = request.args.get('key')
+        upload = request.files.get('file')
+        rows = bulk.csv_rows(upload.stream if upload else request.stream)
+
+    # Authenticator
+    if not verify_key(key):
+        return jsonify({'message': 'Not Authenticated'}), 401
+
+    inserted = 0
+    error_count = 0
+    errors = []
+    try:
+        for chunk in bulk.chunks(rows):
+            values = []
+            for row_number, row in chunk:
+                item, error = bulk.parse_item(row)
+                if error:
+                    error_count += 1
+                    if len(errors) < bulk.MAX_REPORTED_ERRORS:
+                        errors.append({'row': row_number, 'message': error})
+                else:
+                    values.append(item)
+            if values:
+                # One transaction per chunk keeps write locks short
+                db.write(db.INVENTORY_DB, lambda cursor: insert_items(cursor, values))
+                response_cache.bump('items')
+                inserted += len(values)
+
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'message': f'Invalid CSV upload: {e}', 'inserted': inserted}), 400
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'message': 'Failed to add items', 'inserted': inserted}), 500
+
+    return jsonify({
+        'message': 'Items added',
+        'inserted': inserted,
+        'failed': error_count,
+        'errors': errors
+    }), 200
+
+
+@api.route('/dealers', methods=['GET'])
+@cached_response('dealers')
 def get_dealers():
     # Authenticator
     key = request.args.get('key')
     if not verify_key(key):
         return jsonify({'message': 'Not Authenticated'}), 401
+    if streaming.wants_stream():
+        return streaming.stream_list(streaming.query_items(
+            db.INVENTORY_DB, "SELECT name FROM dealers", (), lambda dealer: dealer[0]))
     try:
-        with sqlite3.connect('inventory.db') as conn:
+        with db.inventory() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT name FROM dealers")
             dealers = cursor.fetchall()
@@ -206,15 +403,19 @@ def get_dealers():
         return jsonify({'message': 'Failed to fetch dealer names'}), 500
 
 
-@app.route('/customers', methods=['GET'])
+@api.route('/customers', methods=['GET'])
+@cached_response('customers')
 def get_customers():
 
     # Authenticator
     key = request.args.get('key')
     if not verify_key(key):
         return jsonify({'message': 'Not Authenticated'}), 401
+    if streaming.wants_stream():
+        return streaming.stream_list(streaming.query_items(
+            db.INVENTORY_DB, "SELECT name FROM customers", (), lambda customer: customer[0]))
     try:
-        with sqlite3.connect('inventory.db') as conn:
+        with db.inventory() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT name FROM customers")
             customers = cursor.fetchall()
@@ -226,7 +427,7 @@ def get_customers():
         return jsonify({'message': 'Failed to fetch customer names'}), 500
 
 
-@app.route('/add-dealer', methods=['POST'])
+@api.route('/add-dealer', methods=['POST'])
 def add_dealer():
     data = request.get_json()
     required_fields = ['name', 'address',
@@ -241,13 +442,12 @@ def add_dealer():
     if not verify_key(key):
         return jsonify({'message': 'Not Authenticated'}), 401
     try:
-        with sqlite3.connect('inventory.db') as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO dealers (name, address, phone_no, email, panno, dd_reg)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (data['name'], data['address'], data['phoneNo'], data['email'], data['panno'], data['dd_reg']))
-            conn.commit()
+        db.write(db.INVENTORY_DB, lambda cursor: cursor.execute('''
+            INSERT INTO dealers (name, address, phone_no, email, panno, dd_reg, phone_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (data['name'], data['address'], data['phoneNo'], data['email'], data['panno'], data['dd_reg'],
+              customers.normalize_phone(data['phoneNo']))))
+        response_cache.bump('dealers')
         return jsonify({'message': 'Dealer added successfully', 'data': data}), 200
 
     except sqlite3.Error as e:
@@ -255,33 +455,178 @@ def add_dealer():
         return jsonify({'message': 'Failed to add dealer'}), 500
 
 
-@app.route('/products', methods=['GET'])
+# Response field -> items column for GET /products
+PRODUCT_FIELDS = {
+    'id': 'id',
+    'name': 'item',
+    'manufacture_date': 'manufacture_date',
+    'expiry_date': 'expiry_date',
+    'batch_no': 'batch_no',
+    'price': 'price',
+    'quantity': 'quantity',
+}
+MAX_PAGE_SIZE = 500
+
+
+def int_arg(name, default=None):
+    # Like request.args.get(name, default, type=int), but a value that is
+    # not an integer raises ValueError instead of silently becoming the default
+    value = request.args.get(name)
+    return default if value is None else int(value)
+
+
+@api.route('/products', methods=['GET'])
+@cached_response('items')
 def get_products():
     # Authenticator
     key = request.args.get('key')
     if not verify_key(key):
-        print("Not authenticated")
         return jsonify({'message': 'Not Authenticated'}), 401
 
+    # Optional projection, e.g. fields=id,name,quantity
+    fields = list(PRODUCT_FIELDS)
+    if request.args.get('fields'):
+        fields = [field.strip() for field in request.args['fields'].split(',')]
+        unknown_fields = [field for field in fields if field not in PRODUCT_FIELDS]
+        if unknown_fields:
+            return jsonify({'message': f'Unknown fields: {", ".join(unknown_fields)}'}), 400
+
+    # Keyset pagination on id; without limit the full list is returned as before
+    try:
+        limit = int_arg('limit')
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError
+    except ValueError:
+        return jsonify({'message': f'limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
     try:
-        with sqlite3.connect('inventory.db') as conn:
+        after = int_arg('after', 0)
+        if after < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'message': 'after must be a product id'}), 400
+
+    columns = ', '.join(PRODUCT_FIELDS[field] for field in fields)
+    query = f'SELECT id, {columns} FROM items WHERE id > ?'
+    params = [after]
+    if request.args.get('in_stock', '').lower() in ('1', 'true', 'yes'):
+        query += ' AND quantity > 0'
+    query += ' ORDER BY id'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    elif streaming.wants_stream():
+        return streaming.stream_list(streaming.query_items(
+            db.INVENTORY_DB, query, params, lambda item: dict(zip(fields, item[1:]))))
+
+    try:
+        with db.inventory() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, item, manufacture_date, expiry_date, batch_no, price, quantity
-                FROM items
-            ''')
+            cursor.execute(query, params)
             items = cursor.fetchall()
 
-        products = [{'id': item[0], 'name': item[1], 'manufacture_date': item[2], 'expiry_date': item[3],
-                     'batch_no': item[4], 'price': item[5], 'quantity': item[6]} for item in items]
-        return jsonify(products), 200
+        products = [dict(zip(fields, item[1:])) for item in items]
+        if limit is None:
+            return jsonify(products), 200
+
+        next_after = items[-1][0] if len(items) == limit else None
+        return jsonify({'products': products, 'next_after': next_after}), 200
 
     except sqlite3.Error as e:
         logging.error(f"SQLite error: {e}")
         return jsonify({'message': 'Failed to fetch products'}), 500
 
 
-@app.route('/sell', methods=['POST'])
+@api.route('/search', methods=['GET'])
+@cached_response('items', 'dealers', 'customers')
+def search_catalogue():
+    # Type-ahead search, e.g. /search?q=para&type=items,customers&limit=5
+    key = request.args.get('key')
+    if not verify_key(key):
+        return jsonify({'message': 'Not Authenticated'}), 401
+
+    words = search.query_words(request.args.get('q'))
+    if not words:
+        return jsonify({'message': 'q must contain a word to search for'}), 400
+    kinds = list(search.SOURCES)
+    if request.args.get('type'):
+        kinds = [kind.strip() for kind in request.args['type'].split(',')]
+        unknown_kinds = [kind for kind in kinds if kind not in search.SOURCES]
+        if unknown_kinds:
+            return jsonify({'message': f'Unknown types: {", ".join(unknown_kinds)}'}), 400
+    try:
+        limit = int_arg('limit', search.DEFAULT_LIMIT)
+        if not 0 < limit <= search.MAX_LIMIT:
+            raise ValueError
+    except ValueError:
+        return jsonify({'message': f'limit must be between 1 and {search.MAX_LIMIT}'}), 400
+
+    try:
+        with db.inventory() as conn:
+            return jsonify(search.search(conn.cursor(), words, kinds, limit)), 200
+
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'message': 'Failed to search'}), 500
+
+
+MAX_EXPIRY_WINDOW_DAYS = 3650
+
+
+@api.route('/products/expiring', methods=['GET'])
+def get_expiring_products():
+    # Not response-cached: the window moves every day even when items do not
+    key = request.args.get('key')
+    if not verify_key(key):
+        return jsonify({'message': 'Not Authenticated'}), 401
+
+    try:
+        within_days = int_arg('within_days', expiry.DEFAULT_ALERT_DAYS)
+        if not 0 <= within_days <= MAX_EXPIRY_WINDOW_DAYS:
+            raise ValueError
+    except ValueError:
+        return jsonify({'message': f'within_days must be between 0 and {MAX_EXPIRY_WINDOW_DAYS}'}), 400
+    try:
+        limit = int_arg('limit')
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError
+    except ValueError:
+        return jsonify({'message': f'limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+
+    today = date.today()
+    params = [(today + timedelta(days=within_days)).isoformat()]
+    if limit is not None:
+        params.append(limit)
+
+    try:
+        with db.inventory() as conn:
+            cursor = conn.cursor()
+            cursor.execute(expiry.expiring_query(limit), params)
+            items = cursor.fetchall()
+
+        # days_left is negative for batches that have already expired
+        return jsonify([{
+            'id': id,
+            'name': item,
+            'batch_no': batch_no,
+            'quantity': quantity,
+            'expiry_date': expiry_date,
+            'expires_on': expiry_day,
+            'days_left': (date.fromisoformat(expiry_day) - today).days,
+        } for id, item, batch_no, quantity, expiry_date, expiry_day in items]), 200
+
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'message': 'Failed to fetch expiring products'}), 500
+
+
+class InsufficientStock(Exception):
+    # Raised inside a sale's write transaction to roll it back
+    def __init__(self, items):
+        super().__init__(items)
+        self.items = items  # (product_id, batch_no) pairs
+
+
+@api.route('/sell', methods=['POST'])
 def sell_product():
     data = request.get_json()
     required_fields = ['productIds', 'batchNo', 'quantity',
@@ -302,39 +647,40 @@ def sell_product():
 
     if not isinstance(product_ids, list) or not isinstance(batch_nos, list) or len(product_ids) != len(batch_nos):
         return jsonify({'message': 'productIds and batchNo must be lists of the same length'}), 400
-    if not isinstance(quantity, int):
-        return jsonify({'message': 'quantity must be an integer'}), 400
-    if not isinstance(total_price, (int, float)):
+    # A negative quantity would pass the stock check and add stock instead
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+        return jsonify({'message': 'quantity must be a positive integer'}), 400
+    if not isinstance(total_price, (int, float)) or isinstance(total_price, bool):
         return jsonify({'message': 'total_price must be a number'}), 400
 
-    try:
-        with sqlite3.connect('inventory.db') as conn:
-            cursor = conn.cursor()
+    def sell(cursor):
+        # Repeat buyers are matched by phone number instead of added again
+        customer_id = customers.upsert(cursor, data['customerName'], data['phoneNo'], data['address'])
+
+        # A null batchNo sells from the item's batches, first expiry first
+        lines, short = expiry.allocate(cursor, [(product_id, batch_no, quantity, total_price)
+                                                for product_id, batch_no in zip(product_ids, batch_nos)])
+        if short:
+            raise InsufficientStock(short)
+
+        for product_id, batch_no, line_quantity, line_price in lines:
+            # Check and decrement in one statement so stock can never go negative
+            if not take_stock(cursor, product_id, batch_no, line_quantity):
+                raise InsufficientStock([(product_id, batch_no)])
+
             cursor.execute('''
-                INSERT INTO customers (name, phone_no, address)
-                VALUES (?, ?, ?)
-            ''', (data['customerName'], data['phoneNo'], data['address']))
-            customer_id = cursor.lastrowid
-
-            for product_id, batch_no in zip(product_ids, batch_nos):
-                if not check_quantity(cursor, product_id, batch_no, quantity):
-                    conn.rollback()
-                    return jsonify({'message': f'Not enough quantity for product ID {product_id} and batch no {batch_no}'}), 400
-
-                cursor.execute('''
-                    INSERT INTO sales (product_id, customer_id, quantity, total_price)
-                    VALUES (?, ?, ?, ?)
-                ''', (product_id, customer_id, quantity, total_price))
-
-                cursor.execute('''
-                    UPDATE items
-                    SET quantity = quantity - ?
-                    WHERE id = ? AND batch_no = ?
-                ''', (quantity, product_id, batch_no))
-
-            conn.commit()
+                INSERT INTO sales (product_id, customer_id, quantity, total_price)
+                VALUES (?, ?, ?, ?)
+            ''', (product_id, customer_id, line_quantity, line_price))
+
+    try:
+        db.write(db.INVENTORY_DB, sell)
+        response_cache.bump('items', 'customers')
         return jsonify({'message': 'Product(s) sold successfully'}), 200
 
+    except InsufficientStock as e:
+        product_id, batch_no = e.items[0]
+        return jsonify({'message': f'Not enough quantity for product ID {product_id} and batch no {batch_no}'}), 400
     except sqlite3.Error as e:
         logging.error(f"SQLite error: {e}")
         return jsonify({'message': 'Failed to sell product'}), 500
@@ -349,72 +695,276 @@ def check_quantity(cursor, product_id, batch_no, quantity):
     return True
 
 
-@app.route('/daily-report', methods=['GET'])
-def daily_report():
-    report_date = request.args.get('date', date.today().isoformat())
-    dealer_name = request.args.get('dealer_name')
-    customer_name = request.args.get('customer_name')
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    key = request.args.get('key')
+def take_stock(cursor, product_id, batch_no, quantity):
+    # False, and nothing changed, when the batch has less than ``quantity``
+    cursor.execute('''
+        UPDATE items
+        SET quantity = quantity - ?
+        WHERE id = ? AND batch_no = ? AND quantity >= ?
+    ''', (quantity, product_id, batch_no, quantity))
+    return cursor.rowcount == 1
+
+
+MAX_SALE_LINES = 500
+
+
+def parse_sale_lines(lines):
+    # Returns (product_id, batch_no, quantity, total_price) tuples or an error message
+    if not isinstance(lines, list) or not lines:
+        return None, 'items must be a non-empty list'
+    if len(lines) > MAX_SALE_LINES:
+        return None, f'At most {MAX_SALE_LINES} items can be sold at once'
+    parsed = []
+    for index, line in enumerate(lines):
+        if not isinstance(line, dict) or not all(field in line for field in ['productId', 'quantity', 'total_price']):
+            return None, f'items[{index}] needs productId, quantity and total_price'
+        # Without batchNo the batch is chosen first-expired-first-out
+        batch_no = line.get('batchNo')
+        if not isinstance(line['productId'], int) or not isinstance(batch_no, (str, type(None))):
+            return None, f'items[{index}] needs an integer productId and a string batchNo'
+        quantity = line['quantity']
+        total_price = line['total_price']
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+            return None, f'items[{index}].quantity must be a positive integer'
+        if not isinstance(total_price, (int, float)) or isinstance(total_price, bool):
+            return None, f'items[{index}].total_price must be a number'
+        parsed.append((line['productId'], batch_no, quantity, total_price))
+    return parsed, None
+
+
+def find_short_stock(cursor, lines):
+    # One query for every line: (product_id, batch_no) pairs without enough stock
+    wanted = {}
+    for product_id, batch_no, quantity, _ in lines:
+        wanted[(product_id, batch_no)] = wanted.get((product_id, batch_no), 0) + quantity
+    values = ', '.join(['(?, ?, ?)'] * len(wanted))
+    params = [value for (product_id, batch_no), quantity in wanted.items()
+              for value in (product_id, batch_no, quantity)]
+    cursor.execute(f'''
+        WITH wanted(id, batch_no, quantity) AS (VALUES {values})
+        SELECT w.id, w.batch_no
+        FROM wanted w
+        LEFT JOIN items i ON i.id = w.id AND i.batch_no = w.batch_no
+        WHERE i.id IS NULL OR i.quantity < w.quantity
+    ''', params)
+    return cursor.fetchall()
+
+
+@api.route('/sell/v2', methods=['POST'])
+def sell_products():
+    data = request.get_json()
+    required_fields = ['items', 'customerName', 'phoneNo', 'address', 'key']
+    if not all(field in data for field in required_fields):
+        missing_fields = [
+            field for field in required_fields if field not in data]
+        return jsonify({'message': f'Missing fields: {", ".join(missing_fields)}'}), 400
 
+    # Authenticator
+    key = data['key']
     if not verify_key(key):
         return jsonify({'message': 'Not Authenticated'}), 401
 
+    lines, error = parse_sale_lines(data['items'])
+    if error:
+        return jsonify({'message': error}), 400
+
+    def sell(cursor):
+        # Runs with the write lock held, so the stock check stays valid.
+        # Returns the lines with every batch filled in.
+        batch_lines, short = expiry.allocate(cursor, lines)
+        short = short or find_short_stock(cursor, batch_lines)
+        if short:
+            raise InsufficientStock(short)
+
+        # Repeat buyers are matched by phone number instead of added again
+        customer_id = customers.upsert(cursor, data['customerName'], data['phoneNo'], data['address'])
+
+        cursor.executemany('''
+            INSERT INTO sales (product_id, customer_id, quantity, total_price)
+            VALUES (?, ?, ?, ?)
+        ''', [(product_id, customer_id, quantity, total_price)
+              for product_id, _, quantity, total_price in batch_lines])
+        cursor.executemany('''
+            UPDATE items
+            SET quantity = quantity - ?
+            WHERE id = ? AND batch_no = ? AND quantity >= ?
+        ''', [(quantity, product_id, batch_no, quantity)
+              for product_id, batch_no, quantity, _ in batch_lines])
+        # Every line must have matched, or another sale got there first
+        if cursor.rowcount != len(batch_lines):
+            raise InsufficientStock(find_short_stock(cursor, batch_lines))
+        return batch_lines
+
     try:
-        with sqlite3.connect('inventory.db') as conn:
+        batch_lines = db.write(db.INVENTORY_DB, sell)
+        response_cache.bump('items', 'customers')
+        result = {'message': 'Product(s) sold successfully', 'lines': len(lines)}
+        # Tell the caller which batches were chosen for lines without one
+        if any(batch_no is None for _, batch_no, _, _ in lines):
+            result['batches'] = [{'productId': product_id, 'batchNo': batch_no, 'quantity': quantity}
+                                 for product_id, batch_no, quantity, _ in batch_lines]
+        return jsonify(result), 200
+
+    except InsufficientStock as e:
+        return jsonify({
+            'message': 'Not enough quantity',
+            'items': [{'productId': product_id, 'batchNo': batch_no} for product_id, batch_no in e.items]
+        }), 400
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'message': 'Failed to sell product'}), 500
+
+
+@api.route('/stock', methods=['GET'])
+def get_stock():
+    # Stock of one item batch, now or at the end of a past day (?at=YYYY-MM-DD)
+    key = request.args.get('key')
+    if not verify_key(key):
+        return jsonify({'message': 'Not Authenticated'}), 401
+
+    product_id = request.args.get('productId', type=int)
+    if product_id is None:
+        return jsonify({'message': 'productId must be an integer'}), 400
+    at = request.args.get('at')
+    if at is not None:
+        try:
+            at = date.fromisoformat(at).isoformat()
+        except ValueError:
+            return jsonify({'message': 'at must be a date (YYYY-MM-DD)'}), 400
+
+    try:
+        with db.inventory() as conn:
             cursor = conn.cursor()
+            if at is not None:
+                quantity = ledger.stock_at(cursor, at, product_id).get(product_id, 0)
+            else:
+                cursor.execute('SELECT quantity FROM items WHERE id = ?', (product_id,))
+                item = cursor.fetchone()
+                if item is None:
+                    return jsonify({'message': 'Product not found'}), 404
+                quantity = item[0]
+        return jsonify({'productId': product_id, 'quantity': quantity, 'at': at}), 200
+
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'message': 'Failed to fetch stock'}), 500
+
 
-            query = '''
-                SELECT 'Added' AS type, item, quantity, batch_no, manufacture_date AS date, dealer_name, added_date, NULL AS customer_name, NULL AS total_price
-                FROM items
-                WHERE date(added_date) = ?
-            '''
-            params = [report_date]
+@api.route('/stock/adjust', methods=['POST'])
+def adjust_stock():
+    # Corrections such as breakage or a recount; quantity is the signed change
+    data = request.get_json()
+    required_fields = ['productId', 'batchNo', 'quantity', 'key']
+    if not all(field in data for field in required_fields):
+        missing_fields = [
+            field for field in required_fields if field not in data]
+        return jsonify({'message': f'Missing fields: {", ".join(missing_fields)}'}), 400
+
+    # Authenticator
+    key = data['key']
+    if not verify_key(key):
+        return jsonify({'message': 'Not Authenticated'}), 401
 
-            if dealer_name:
-                query += ' AND dealer_name = ?'
-                params.append(dealer_name)
+    product_id = data['productId']
+    batch_no = data['batchNo']
+    quantity = data['quantity']
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity == 0:
+        return jsonify({'message': 'quantity must be a non-zero integer'}), 400
 
-            if start_date and end_date:
-                query += ' AND date(added_date) BETWEEN ? AND ?'
-                params.extend([start_date, end_date])
+    def adjust(cursor):
+        balance = ledger.adjust(cursor, product_id, batch_no, quantity, data.get('reason'))
+        if balance is None:
+            raise InsufficientStock([(product_id, batch_no)])
+        return balance
 
-            query += '''
-                UNION ALL
+    try:
+        balance = db.write(db.INVENTORY_DB, adjust)
+        response_cache.bump('items')
+        return jsonify({'message': 'Stock adjusted', 'quantity': balance}), 200
 
-                SELECT 'Sold' AS type, i.item, s.quantity, i.batch_no, i.manufacture_date AS date, NULL AS dealer_name, s.sale_date AS added_date, c.name as customer_name, s.total_price
-                FROM sales s
-                JOIN items i ON s.product_id = i.id
-                LEFT JOIN customers c ON s.customer_id = c.id
-                WHERE date(s.sale_date) = ?
-            '''
-            params.append(report_date)
+    except InsufficientStock:
+        return jsonify({'message': f'Not enough quantity for product ID {product_id} and batch no {batch_no}'}), 400
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'message': 'Failed to adjust stock'}), 500
 
-            if customer_name:
-                query += ' AND c.name = ?'
-                params.append(customer_name)
 
-            if start_date and end_date:
-                query += ' AND date(s.sale_date) BETWEEN ? AND ?'
-                params.extend([start_date, end_date])
+@api.route('/daily-report', methods=['GET'])
+def daily_report():
+    report_date = request.args.get('date', date.today().isoformat())
+    dealer_name = request.args.get('dealer_name')
+    customer_name = request.args.get('customer_name')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    key = request.args.get('key')
 
-            cursor.execute(query, params)
+    if not verify_key(key):
+        return jsonify({'message': 'Not Authenticated'}), 401
+
+    # Both halves read the daily_rollup table kept up to date by triggers
+    added_query = reports.ADDED_QUERY
+    added_params = [report_date]
+
+    if dealer_name:
+        added_query += ' AND dealer_name = ?'
+        added_params.append(dealer_name)
+
+    if start_date and end_date:
+        added_query += ' AND day BETWEEN ? AND ?'
+        added_params.extend([start_date, end_date])
+
+    sold_query = reports.SOLD_QUERY
+    sold_params = [report_date]
+
+    if customer_name:
+        sold_query += ' AND customer_name = ?'
+        sold_params.append(customer_name)
+
+    if start_date and end_date:
+        sold_query += ' AND day BETWEEN ? AND ?'
+        sold_params.extend([start_date, end_date])
+
+    def make_product(product):
+        return {
+            'item': product[1],
+            'quantity': product[2],
+            'batch_no': product[3],
+            'date': product[4],
+            'dealer_name': product[5],
+            'added_date': product[6],
+            'customer_name': product[7],
+            'total_price': product[8]
+        }
+
+    if streaming.wants_stream():
+        added = streaming.query_items(
+            db.INVENTORY_DB, added_query, added_params, make_product)
+        sold = streaming.query_items(
+            db.INVENTORY_DB, sold_query, sold_params, make_product)
+        if streaming.wants_ndjson():
+            def typed(items, kind):
+                for item in items:
+                    item['type'] = kind
+                    yield item
+            return streaming.stream_list(
+                itertools.chain(typed(added, 'added'), typed(sold, 'sold')))
+        return streaming.stream_response(streaming.json_object([
+            ('date', report_date),
+            ('added_products', added),
+            ('sold_products', sold),
+        ]))
+
+    try:
+        with db.inventory() as conn:
+            cursor = conn.cursor()
+            cursor.execute(added_query + ' UNION ALL ' + sold_query,
+                           added_params + sold_params)
             products = cursor.fetchall()
 
         added_products = []
         sold_products = []
         for product in products:
-            product_data = {
-                'item': product[1],
-                'quantity': product[2],
-                'batch_no': product[3],
-                'date': product[4],
-                'dealer_name': product[5],
-                'added_date': product[6],
-                'customer_name': product[7],
-                'total_price': product[8]
-            }
+            product_data = make_product(product)
             if product[0] == 'Added':
                 added_products.append(product_data)
             else:
@@ -436,7 +986,51 @@ def daily_report():
         return jsonify({'message': 'Failed to load daily report'}), 500
 
 
-@app.route('/clear-data', methods=['POST'])
+@api.route('/report', methods=['GET'])
+def range_report():
+    key = request.args.get('key')
+    if not verify_key(key):
+        return jsonify({'message': 'Not Authenticated'}), 401
+
+    end_date = request.args.get('end_date', date.today().isoformat())
+    start_date = request.args.get('start_date', end_date)
+    group_by = request.args.get('group_by', 'day')
+    try:
+        date.fromisoformat(start_date)
+        date.fromisoformat(end_date)
+    except ValueError:
+        return jsonify({'message': 'start_date and end_date must be YYYY-MM-DD'}), 400
+    if group_by not in reports.GROUP_BY:
+        return jsonify({'message': f'group_by must be one of: {", ".join(reports.GROUP_BY)}'}), 400
+
+    where, params = reports.range_filter(start_date, end_date,
+                                         request.args.get('dealer_name'),
+                                         request.args.get('customer_name'))
+    try:
+        with db.inventory() as conn:
+            cursor = conn.cursor()
+            cursor.execute(reports.totals_query(where), params)
+            added_units, sold_units, revenue = cursor.fetchone()
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'message': 'Failed to generate report'}), 500
+
+    def make_group(row):
+        return {'group': row[0], 'added_units': row[1], 'sold_units': row[2], 'revenue': row[3]}
+
+    # Groups are streamed so long ranges grouped by item or customer stay small in memory
+    groups = streaming.query_items(
+        db.INVENTORY_DB, reports.grouped_query(group_by, where), params, make_group)
+    return streaming.stream_response(streaming.json_object([
+        ('start_date', start_date),
+        ('end_date', end_date),
+        ('group_by', group_by),
+        ('totals', {'added_units': added_units or 0, 'sold_units': sold_units or 0, 'revenue': revenue}),
+        ('groups', groups),
+    ]))
+
+
+@api.route('/clear-data', methods=['POST'])
 def clear_data():
     data = request.get_json()
     clear_items = data.get('clear_items', False)
@@ -447,19 +1041,22 @@ def clear_data():
 
     if not verify_key(key):
         return jsonify({'message': 'Not Authenticated'}), 401
-    try:
-        with sqlite3.connect('inventory.db') as conn:
-            cursor = conn.cursor()
-            if clear_items:
-                cursor.execute("DELETE FROM items")
-            if clear_sales:
-                cursor.execute("DELETE FROM sales")
-            if clear_customers:
-                cursor.execute("DELETE FROM customers")
-            if clear_dealers:
-                cursor.execute("DELETE FROM dealers")
-            conn.commit()
+    def clear(cursor):
+        if clear_items:
+            cursor.execute("DELETE FROM items")
+            ledger.clear(cursor)
+        if clear_sales:
+            cursor.execute("DELETE FROM sales")
+        if clear_customers:
+            cursor.execute("DELETE FROM customers")
+        if clear_dealers:
+            cursor.execute("DELETE FROM dealers")
+        reports.clear_rollup(cursor, items=clear_items,
+                             sales=clear_sales, customers=clear_customers)
 
+    try:
+        db.write(db.INVENTORY_DB, clear)
+        response_cache.bump('items', 'sales', 'customers', 'dealers')
         return jsonify({'message': 'Data cleared successfully'}), 200
 
     except sqlite3.Error as e:
@@ -467,7 +1064,16 @@ def clear_data():
         return jsonify({'message': 'Failed to clear data'}), 500
 
 
-@app.route('/version-manager', methods=['POST'])
+@api.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    key = request.args.get('key')
+    if not verify_key(key):
+        return jsonify({'message': 'Not Authenticated'}), 401
+    return jsonify({'key_cache': key_cache.stats(),
+                    'response_cache': response_cache.stats()}), 200
+
+
+@api.route('/version-manager', methods=['POST'])
 def version():
     data = request.get_json()
  # List of required fields
@@ -479,37 +1085,55 @@ def version():
             field for field in required_fields if field not in data]
         return jsonify({'message': f'Missing fields: {", ".join(missing_fields)}'}), 400
 
-    # reads the url file for the latest url
-    with open('url', 'r') as file:
-        content = file.read()
+    # Release metadata is served from memory and reloaded when the files change
+    channel = data.get('channel', versions.STABLE_CHANNEL)
+    release = version_registry.get(channel)
+    if release is None:
+        return jsonify({'message': f'Unknown release channel: {channel}'}), 404
 
-    with open('version', 'r') as file2:
-        ver = file2.read()
-    print(ver)
-    print(content)
-    # Latest version
-    global_version = f'v{ver}'
-    new_version_url = content.strip()
-    new_version_url = new_version_url+'/app-release.apk'
+    global_version = release.version
+    new_version_url = release.url
 
     client_version = data['version']
 
     # Check if client version matches the global version
     if client_version != global_version:
-        print('update_needed')
+        required = (release.min_version is not None and
+                    versions.parse_version(client_version) < versions.parse_version(release.min_version))
         return jsonify({
             'status': 'update_needed',
             'global_version': global_version,
             'url': new_version_url,
+            'required': required,
             'message': f'New version available: {global_version}'
         }), 200
 
     # If versions match, return a success message
-    print('up_to_date')
     return jsonify({'status': 'up_to_date', 'message': 'Version is up to date'}), 200
 
 
-@app.route('/notice', methods=['POST'])
+# Scheduled broadcasts are sent by the deliver_notifications job when the
+# scheduler runs; readers also send any that are due, so they arrive without
+# it. The check is an indexed read, made at most once a second per process.
+DELIVERY_CHECK_INTERVAL = 1
+next_delivery_check = 0
+
+
+def deliver_scheduled():
+    global next_delivery_check
+    now = time.monotonic()
+    if now < next_delivery_check:
+        return
+    next_delivery_check = now + DELIVERY_CHECK_INTERVAL
+    with db.notifications() as conn:
+        if not add_notify.any_due(conn.cursor()):
+            return
+    batches, sent = db.write(db.NOTIFICATION_DB, add_notify.deliver_pending)
+    if sent:
+        notification_bus.wake()
+
+
+@api.route('/notice', methods=['POST'])
 def notice():
     data = request.get_json()
     # List of required fields
@@ -526,32 +1150,32 @@ def notice():
     if not verify_key(key):
         return jsonify({'message': 'Not Authenticated'}), 401
 
-    status = 0
+    deliver_scheduled()
 
-    # Fetch the notification
-    with sqlite3.connect('login_notification_data.db') as conn2:
-        cursor2 = conn2.cursor()
-        cursor2.execute(
-            'SELECT id,body, title FROM notifications WHERE key=? AND status=?', (key, status))
-        dd2 = cursor2.fetchall()
-
-    if not dd2:
-        return jsonify({'message': 'No notifications found'}), 404
+    # Read the oldest unread notification, then claim it with a conditional
+    # update; polls that find nothing never take the write lock. A row
+    # another request claimed first is skipped.
+    def claim(cursor):
+        cursor.execute('UPDATE notifications SET status = 1 WHERE id = ? AND status = 0', (notification[0],))
+        return cursor.rowcount == 1
 
-    id, body, title = dd2[0]
+    while True:
+        with db.notifications() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT id, body, title FROM notifications WHERE key=? AND status=0 ORDER BY id LIMIT 1', (key,))
+            notification = cursor.fetchone()
+        if notification is None:
+            return jsonify({'message': 'No notifications found'}), 404
+        if db.write(db.NOTIFICATION_DB, claim):
+            break
 
-    # Update the notification status
-    new_status = 1
-    with sqlite3.connect('login_notification_data.db') as conn3:
-        cursor3 = conn3.cursor()
-        cursor3.execute(
-            'UPDATE notifications SET status = ? WHERE key = ? AND id=?', (new_status, key, id))
-        conn3.commit()
+    id, body, title = notification
 
     return jsonify({'message': 'Authenticated', 'title': title, 'body': body})
 
 
-@app.route('/notices', methods=['POST'])
+@api.route('/notices', methods=['POST'])
 def notices():
     data = request.get_json()
     # List of required fields
@@ -568,15 +1192,272 @@ def notices():
     if not verify_key(key):
         return jsonify({'message': 'Not Authenticated'}), 401
 
-    with sqlite3.connect('login_notification_data.db') as conn2:
+    deliver_scheduled()
+    query = 'SELECT body, title FROM notifications WHERE key=?'
+
+    def make_notification(ntfy):
+        return {'message': 'Authentiated', 'title': ntfy[1], 'body': ntfy[0]}
+
+    if streaming.wants_stream():
+        return streaming.stream_list(streaming.query_items(
+            db.NOTIFICATION_DB, query, (key,), make_notification))
+
+    with db.notifications() as conn2:
         cursor2 = conn2.cursor()
-        cursor2.execute(
-            'SELECT body, title FROM notifications WHERE key=?', (key))
+        cursor2.execute(query, (key,))
         dd3 = cursor2.fetchall()
-        notification = [{'message': 'Authentiated',
-                         'title': ntfy[1], 'body': ntfy[0]} for ntfy in dd3]
+        notification = [make_notification(ntfy) for ntfy in dd3]
     return jsonify(notification), 200
 
 
+# Long-poll and Server-Sent Events settings for /notifications/stream
+LONG_POLL_TIMEOUT = 25
+MAX_LONG_POLL_TIMEOUT = 60
+SSE_KEEPALIVE = 15
+
+
+def long_poll_timeout(value):
+    # Seconds to wait, from the ``timeout`` argument clamped to
+    # [0, MAX_LONG_POLL_TIMEOUT]; text or NaN gives the default
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        return LONG_POLL_TIMEOUT
+    if math.isnan(timeout):
+        return LONG_POLL_TIMEOUT
+    return max(0.0, min(timeout, MAX_LONG_POLL_TIMEOUT))
+
+
+def mark_notifications_read(key, ids):
+    db.write(db.NOTIFICATION_DB, lambda cursor: cursor.execute(
+        f'UPDATE notifications SET status = 1 WHERE key = ? AND id IN ({", ".join("?" * len(ids))})',
+        [key, *ids]))
+
+
+def unread_notifications(key):
+    with db.notifications() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT id, title, body FROM notifications WHERE key=? AND status=0 ORDER BY id', (key,))
+        return cursor.fetchall()
+
+
+def sse_event(id, title, body):
+    return f'id: {id}\nevent: notification\ndata: {json.dumps({"id": id, "title": title, "body": body})}\n\n'
+
+
+@api.route('/notifications/stream', methods=['GET'])
+def notification_stream():
+    key = request.args.get('key')
+    if not verify_key(key):
+        return jsonify({'message': 'Not Authenticated'}), 401
+
+    # Subscribe before reading unread rows so nothing inserted in between is missed
+    subscription = notification_bus.subscribe(key)
+    try:
+        deliver_scheduled()
+        pending = unread_notifications(key)
+    except sqlite3.Error as e:
+        notification_bus.unsubscribe(subscription)
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'message': 'Failed to fetch notifications'}), 500
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        def events():
+            last_id = 0
+            rows = pending
+            try:
+                while True:
+                    rows = [row for row in rows if row[0] > last_id]
+                    if rows:
+                        mark_notifications_read(key, [row[0] for row in rows])
+                        last_id = rows[-1][0]
+                        for row in rows:
+                            yield sse_event(*row)
+                    else:
+                        # Lets the server notice clients that have gone away
+                        yield ': keepalive\n\n'
+                    rows = subscription.get(SSE_KEEPALIVE)
+            finally:
+                notification_bus.unsubscribe(subscription)
+
+        return Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    # Long poll: answer at once if something is unread, else wait for a new row
+    timeout = long_poll_timeout(request.args.get('timeout', LONG_POLL_TIMEOUT))
+    try:
+        rows = pending or subscription.get(timeout)
+    finally:
+        notification_bus.unsubscribe(subscription)
+    if not rows:
+        return jsonify({'message': 'No notifications found'}), 404
+
+    mark_notifications_read(key, [row[0] for row in rows])
+    return jsonify([{'id': id, 'title': title, 'body': body} for id, title, body in rows]), 200
+
+
+MAX_SYNC_BATCH = 500
+
+
+@api.route('/notifications/sync', methods=['POST'])
+def notifications_sync():
+    data = request.get_json()
+    required_fields = ['key']
+    if not all(field in data for field in required_fields):
+        missing_fields = [
+            field for field in required_fields if field not in data]
+        return jsonify({'message': f'Missing fields: {", ".join(missing_fields)}'}), 400
+
+    key = data['key']
+    if not verify_key(key):
+        return jsonify({'message': 'Not Authenticated'}), 401
+
+    since_id = data.get('since_id', 0)
+    ack = data.get('ack', [])
+    limit = data.get('limit', MAX_SYNC_BATCH)
+    if not isinstance(since_id, int) or isinstance(since_id, bool) or since_id < 0:
+        return jsonify({'message': 'since_id must be a non-negative integer'}), 400
+    if not isinstance(ack, list) or not all(isinstance(id, int) and not isinstance(id, bool) for id in ack):
+        return jsonify({'message': 'ack must be a list of notification ids'}), 400
+    if len(ack) > MAX_SYNC_BATCH:
+        return jsonify({'message': f'At most {MAX_SYNC_BATCH} ids can be acknowledged at once'}), 400
+    if not isinstance(limit, int) or isinstance(limit, bool) or not 0 < limit <= MAX_SYNC_BATCH:
+        return jsonify({'message': f'limit must be between 1 and {MAX_SYNC_BATCH}'}), 400
+
+    def acknowledge(cursor):
+        # The whole batch in one statement
+        cursor.execute(
+            f'UPDATE notifications SET status = 1 WHERE key = ? AND id IN ({", ".join("?" * len(ack))})',
+            [key, *ack])
+        return cursor.rowcount
+
+    try:
+        # Only an ack (or a due scheduled broadcast) takes the write lock;
+        # most syncs just read
+        acknowledged = db.write(db.NOTIFICATION_DB, acknowledge) if ack else 0
+        deliver_scheduled()
+        with db.notifications() as conn:
+            cursor = conn.cursor()
+            # One extra row tells the client whether to sync again straight away
+            cursor.execute('''
+                SELECT id, title, body, status, notification_date FROM notifications
+                WHERE key = ? AND id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (key, since_id, limit + 1))
+            rows = cursor.fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error: {e}")
+        return jsonify({'message': 'Failed to sync notifications'}), 500
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        'notifications': [{'id': id, 'title': title, 'body': body, 'read': bool(status), 'date': notification_date}
+                          for id, title, body, status, notification_date in rows],
+        'acknowledged': acknowledged,
+        'since_id': rows[-1][0] if rows else since_id,
+        'has_more': has_more
+    }), 200
+
+
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+def record_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_metrics.observe_request(route, request.method, response.status_code,
+                                        time.perf_counter() - start)
+    return response
+
+
+def runtime_gauges():
+    # Cache, pool and notification bus state for /metrics
+    key_stats = key_cache.stats()
+    response_stats = response_cache.stats()
+    gauges = [
+        ('svp_cache_hits_total', 'counter', 'Cache hits.',
+         [({'cache': 'key'}, key_stats['hits']), ({'cache': 'response'}, response_stats['hits'])]),
+        ('svp_cache_misses_total', 'counter', 'Cache misses.',
+         [({'cache': 'key'}, key_stats['misses']), ({'cache': 'response'}, response_stats['misses'])]),
+        ('svp_cache_entries', 'gauge', 'Entries held by each cache.',
+         [({'cache': 'key'}, key_stats['size']), ({'cache': 'response'}, response_stats['size'])]),
+        ('svp_response_cache_not_modified_total', 'counter', 'Requests answered with 304 Not Modified.',
+         [({}, response_stats['not_modified'])]),
+        ('svp_db_pool_connections', 'gauge', 'Pooled SQLite connections by state.',
+         [({'database': path, 'state': state}, stats[state])
+          for path, stats in db.pool_stats().items() for state in ('idle', 'in_use')]),
+        ('svp_db_writer_commits_total', 'counter', 'Transactions committed by the writer thread.',
+         [({'database': path}, stats['commits']) for path, stats in db.writer_stats().items()]),
+        ('svp_db_writer_jobs_total', 'counter', 'Writes run by the writer thread.',
+         [({'database': path}, stats['jobs']) for path, stats in db.writer_stats().items()]),
+        ('svp_notification_subscribers', 'gauge', 'Clients waiting on /notifications/stream.',
+         [({}, notification_bus.subscriber_count())]),
+    ]
+    return gauges
+
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if not current_app.config['METRICS']:
+        return jsonify({'message': 'Metrics are disabled'}), 404
+    return Response(request_metrics.render(runtime_gauges()), mimetype=metrics.PROMETHEUS_MIMETYPE)
+
+
+def config_from_env(environ=os.environ):
+    config = {}
+    for name, default in DEFAULT_CONFIG.items():
+        value = environ.get(f'SVP_{name}')
+        if value is None:
+            continue
+        if isinstance(default, bool):
+            value = value.lower() in ('1', 'true', 'yes')
+        elif isinstance(default, int):
+            value = int(value)
+        config[name] = value
+    return config
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config or {})
+
+    # Configure logging
+    logging.basicConfig()
+    logging.getLogger().setLevel(str(app.config['LOG_LEVEL']).upper())
+
+    if app.config['INIT_DB']:
+        create_database_and_tables()
+        # Connections opened during setup must not be shared with forked workers
+        db.close_all()
+
+    if app.config['CACHE_VERSIONS_FILE']:
+        response_cache.share_versions(app.config['CACHE_VERSIONS_FILE'])
+
+    # Timing is only installed when asked for, so it costs nothing otherwise
+    if app.config['SLOW_QUERY_MS']:
+        request_metrics.slow_query_seconds = int(app.config['SLOW_QUERY_MS']) / 1000
+    if app.config['METRICS'] or app.config['SLOW_QUERY_MS']:
+        db.use_connection_class(request_metrics.connection_class())
+    if app.config['METRICS']:
+        app.before_request(start_request_timer)
+        app.after_request(record_request)
+
+    global scheduler_started
+    if app.config['SCHEDULER'] and not scheduler_started:
+        jobs = scheduler.default_jobs(app.config, on_keys=revoke_keys,
+                                      on_notify=notification_bus.wake)
+        scheduler.Scheduler(jobs, on_finish=request_metrics.observe_job).start()
+        scheduler_started = True
+
+    app.register_blueprint(api)
+    return app
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    create_app(config_from_env()).run(host='0.0.0.0', port=5000)
@@ -0,0 +1,539 @@
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+from datetime import date, timedelta
+
+# Benchmarks run against throwaway copies of the databases, never the real ones
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+
+def setup_workdir():
+    workdir = tempfile.mkdtemp(prefix='svp-bench-')
+    os.chdir(workdir)
+    return workdir
+
+
+def login(client):
+    response = client.post('/login', json={
+        'email': 'skbd@skbd.com', 'password': 'skbd0001', 'app': 'svp_admin'})
+    return response.get_json()['key']
+
+
+def seed_items(count):
+    with sqlite3.connect('inventory.db') as conn:
+        conn.executemany('''
+            INSERT INTO items (item, quantity, batch_no, manufacture_date, expiry_date, dealer_name, price)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', ((f'item {i}', 100, f'B{i}', '2024-01-01', '2026-01-01', 'dealer', 10)
+              for i in range(count)))
+
+
+def run_threads(func, threads, seconds):
+    # Run ``func`` in a loop on ``threads`` threads and return calls/sec
+    stop = time.perf_counter() + seconds
+    counts = [0] * threads
+
+    def worker(index):
+        while time.perf_counter() < stop:
+            func()
+            counts[index] += 1
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return sum(counts) / seconds
+
+
+@contextmanager
+def unpooled():
+    # Restore the old behaviour: a brand-new connection for every request
+    import db
+    saved = db.inventory, db.notifications
+
+    @contextmanager
+    def fresh(path):
+        conn = sqlite3.connect(path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    db.inventory = lambda: fresh(db.INVENTORY_DB)
+    db.notifications = lambda: fresh(db.NOTIFICATION_DB)
+    try:
+        yield
+    finally:
+        db.inventory, db.notifications = saved
+
+
+def bench_pool(args):
+    import auth
+    client = auth.create_app().test_client()
+    key = login(client)
+    items = args.items or 100
+    seed_items(items)
+    # Measure the database path, not the response cache
+    auth.response_cache.maxsize = 0
+
+    def products():
+        client.get('/products', query_string={'key': key})
+
+    with unpooled():
+        before = run_threads(products, args.threads, args.seconds)
+    after = run_threads(products, args.threads, args.seconds)
+    print(f'GET /products ({items} items, {args.threads} threads)')
+    print(f'  connect per request: {before:10.1f} req/s')
+    print(f'  pooled connections:  {after:10.1f} req/s')
+
+
+def time_calls(func, seconds):
+    # Call ``func`` repeatedly for ``seconds``; returns per-call latencies
+    latencies = []
+    stop = time.perf_counter() + seconds
+    while True:
+        start = time.perf_counter()
+        if start >= stop:
+            return latencies
+        func()
+        latencies.append(time.perf_counter() - start)
+
+
+def use_data(args, items, sales):
+    # Databases from ``--data`` (made by datagen.py), or freshly generated
+    if args.data:
+        for name in ('inventory.db', 'login_notification_data.db'):
+            shutil.copy(os.path.join(args.data, name), '.')
+    else:
+        import datagen
+        datagen.generate(items=items, sales=sales, customers=max(1, items // 10))
+
+
+def bench_micro(args):
+    import auth
+    import db
+    import reports
+    from loadtest import summarize
+    use_data(args, args.items or 100000, (args.items or 100000) * 2)
+    with db.inventory() as conn:
+        items = conn.execute('SELECT max(id) FROM items').fetchone()[0]
+    with db.notifications() as conn:
+        keys = [row[0] for row in conn.execute('SELECT key FROM login_key')]
+    days = [(date.today() - timedelta(days=offset)).isoformat() for offset in range(365)]
+    report_query = reports.ADDED_QUERY + ' UNION ALL ' + reports.SOLD_QUERY
+
+    def verify_key():
+        auth.verify_key(random.choice(keys))
+
+    def check_quantity():
+        product_id = random.randint(1, items)
+        with db.inventory() as conn:
+            auth.check_quantity(conn.cursor(), product_id, f'B{product_id - 1}', 1)
+
+    def daily_report_query():
+        day = random.choice(days)
+        with db.inventory() as conn:
+            conn.execute(report_query, (day, day)).fetchall()
+
+    results = {}
+    # Uncached first, so verify_key measures the login_key lookup
+    auth.key_cache.maxsize = 0
+    for name, func in (('verify_key', verify_key), ('check_quantity', check_quantity),
+                       ('daily_report_query', daily_report_query)):
+        results[name] = summarize(time_calls(func, args.seconds), 0, args.seconds)
+    auth.key_cache.maxsize = len(keys)
+    results['verify_key_cached'] = summarize(time_calls(verify_key, args.seconds), 0, args.seconds)
+
+    if args.json:
+        print(json.dumps({'benchmark': 'micro', 'items': items, 'keys': len(keys),
+                          'seconds': args.seconds, 'results': results}, indent=2))
+        return
+    print(f'Microbenchmarks ({items} items, {len(keys)} login keys)')
+    print(f"  {'operation':<20} {'calls/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, stats in results.items():
+        print(f"  {name:<20} {stats['rps']:>10.1f} {stats['p50_ms']:>8.3f} "
+              f"{stats['p95_ms']:>8.3f} {stats['p99_ms']:>8.3f}")
+
+
+def bench_writer(args):
+    import auth
+    import db
+    client = auth.create_app().test_client()
+    key = login(client)
+    dealer = {'name': 'bench', 'address': 'a', 'phoneNo': '1', 'email': 'e',
+              'panno': 1, 'dd_reg': 'r', 'key': key}
+
+    def add_dealer():
+        client.post('/add-dealer', json=dealer)
+
+    # Each thread takes the write lock itself, then all writes go through
+    # one writer thread as under asgi.py
+    locking = run_threads(add_dealer, args.threads, args.seconds)
+    db.use_writer_threads()
+    queued = run_threads(add_dealer, args.threads, args.seconds)
+    stats = db.writer_stats()[db.INVENTORY_DB]
+    print(f'POST /add-dealer ({args.threads} threads)')
+    print(f'  BEGIN IMMEDIATE per request: {locking:10.1f} req/s')
+    print(f'  writer thread:               {queued:10.1f} req/s  '
+          f"({stats['jobs'] / max(stats['commits'], 1):.1f} writes per commit)")
+
+
+def bench_verify_key(args):
+    import auth
+    auth.create_database_and_tables()
+    stored = args.keys or 10000
+    with sqlite3.connect('login_notification_data.db') as conn:
+        conn.executemany('INSERT INTO login_key(user, key) VALUES (?, ?)',
+                         ((f'user{i}', f'K{i:07d}') for i in range(stored)))
+    keys = [f'K{i:07d}' for i in range(0, stored, max(1, stored // 1000))]
+    keys += [f'X{i:07d}' for i in range(100)]
+
+    def run(rounds):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for key in keys:
+                auth.verify_key(key)
+        return rounds * len(keys) / (time.perf_counter() - start)
+
+    auth.key_cache.maxsize = 0
+    uncached = run(3)
+    auth.key_cache.maxsize = len(keys)
+    auth.key_cache.invalidate()
+    cached = run(30)
+    print(f'verify_key ({stored} stored keys, {len(keys)} distinct lookups)')
+    print(f'  uncached: {uncached:12.1f} calls/s')
+    print(f'  cached:   {cached:12.1f} calls/s')
+    print(f'  cache:    {auth.key_cache.stats()}')
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_stream(args):
+    import auth
+    client = auth.create_app().test_client()
+    key = login(client)
+    items = args.items or 1000000
+    seed_items(items)
+
+    def buffered():
+        client.get('/products', query_string={'key': key}).close()
+
+    def streamed():
+        response = client.get('/products', query_string={'key': key, 'stream': 1},
+                              buffered=False)
+        for _ in response.iter_encoded():
+            pass
+        response.close()
+
+    print(f'GET /products peak Python memory ({items} items)')
+    for name, func in (('buffered', buffered), ('streamed', streamed)):
+        start = time.perf_counter()
+        peak = peak_memory(func)
+        elapsed = time.perf_counter() - start
+        print(f'  {name}: {peak / 2**20:8.1f} MiB in {elapsed:.1f}s')
+
+
+def bench_sell(args):
+    import auth
+    client = auth.create_app().test_client()
+    key = login(client)
+    seed_items(args.items or 100)
+    customer = {'customerName': 'bench', 'phoneNo': '1', 'address': 'a', 'key': key}
+
+    def timed(url, body, rounds=20):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            client.post(url, json=body)
+        return (time.perf_counter() - start) / rounds * 1000
+
+    print('Checkout latency by invoice size')
+    for lines in (1, 10, 50):
+        v1 = timed('/sell', {**customer, 'productIds': list(range(1, lines + 1)),
+                             'batchNo': [f'B{i - 1}' for i in range(1, lines + 1)],
+                             'quantity': 1, 'total_price': 10})
+        v2 = timed('/sell/v2', {**customer, 'items': [
+            {'productId': i, 'batchNo': f'B{i - 1}', 'quantity': 1, 'total_price': 10}
+            for i in range(1, lines + 1)]})
+        print(f'  {lines:3d} lines: /sell {v1:7.2f} ms   /sell/v2 {v2:7.2f} ms')
+
+
+def bench_oversell(args):
+    # Stress test: many processes and threads selling the same few batches.
+    # Fails unless stock never goes negative and every accepted sale (and
+    # only those) is reflected in items, sales and the stock ledger.
+    import auth
+    import db
+    import ledger
+    app = auth.create_app({'CACHE_VERSIONS_FILE': ''})
+    key = login(app.test_client())
+    items = args.items or 20
+    seed_items(items)
+    db.close_all()
+    per_thread = max(1, args.sells // (args.processes * args.threads))
+
+    def sell_loop(client, accepted, errors):
+        for _ in range(per_thread):
+            product_id = random.randint(1, items)
+            quantity = random.randint(1, 3)
+            if random.random() < 0.5:
+                response = client.post('/sell', json={
+                    'customerName': 'stress', 'phoneNo': '1', 'address': 'a', 'key': key,
+                    'productIds': [product_id], 'batchNo': [f'B{product_id - 1}'],
+                    'quantity': quantity, 'total_price': quantity})
+            else:
+                response = client.post('/sell/v2', json={
+                    'customerName': 'stress', 'phoneNo': '1', 'address': 'a', 'key': key,
+                    'items': [{'productId': product_id, 'batchNo': f'B{product_id - 1}',
+                               'quantity': quantity, 'total_price': quantity}]})
+            if response.status_code == 200:
+                accepted.append((product_id, quantity))
+            elif response.status_code >= 500:
+                errors.append(response.status_code)
+
+    def child(index):
+        random.seed(index)
+        accepted, errors = [], []
+        pool = [threading.Thread(target=sell_loop, args=(app.test_client(), accepted, errors))
+                for _ in range(args.threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        with open(f'oversell-{index}.json', 'w') as file:
+            json.dump({'accepted': accepted, 'errors': len(errors)}, file)
+
+    start = time.perf_counter()
+    children = []
+    for index in range(args.processes):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                child(index)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+    elapsed = time.perf_counter() - start
+
+    sold = {}
+    errors = 0
+    for index in range(args.processes):
+        with open(f'oversell-{index}.json') as file:
+            result = json.load(file)
+        errors += result['errors']
+        for product_id, quantity in result['accepted']:
+            sold[product_id] = sold.get(product_id, 0) + quantity
+    with sqlite3.connect('inventory.db') as conn:
+        stock = dict(conn.execute('SELECT id, quantity FROM items'))
+        recorded = dict(conn.execute('SELECT product_id, sum(quantity) FROM sales GROUP BY product_id'))
+        unbalanced = ledger.check(conn.cursor())
+
+    negative = [product_id for product_id, quantity in stock.items() if quantity < 0]
+    lost = [product_id for product_id in stock
+            if 100 - stock[product_id] != sold.get(product_id, 0)
+            or recorded.get(product_id, 0) != sold.get(product_id, 0)]
+    attempts = per_thread * args.threads * args.processes
+    print(f'{attempts} sells of {items} batches x 100 units from '
+          f'{args.processes} processes x {args.threads} threads in {elapsed:.1f}s')
+    print(f'  accepted: {sum(sold.values())} units, 5xx: {errors}')
+    print(f'  negative stock: {len(negative)} batches, mismatched stock/sales: {len(lost)} batches, '
+          f'stock/ledger: {len(unbalanced)} batches')
+    if negative or lost or unbalanced:
+        sys.exit('FAILED: oversold or lost updates')
+    print('  OK')
+
+
+def bench_bulk(args):
+    import auth
+    client = auth.create_app().test_client()
+    key = login(client)
+    count = args.items or 100000
+    rows = [{'item': f'item {i}', 'quantity': 10, 'batchNo': f'B{i}', 'manufactureDate': '2024-01-01',
+             'expiryDate': '2026-01-01', 'dealerName': 'dealer', 'price': 10} for i in range(count)]
+    csv_body = 'item,quantity,batchNo,manufactureDate,expiryDate,dealerName,price\n' + ''.join(
+        f"{row['item']},10,{row['batchNo']},2024-01-01,2026-01-01,dealer,10\n" for row in rows)
+
+    print(f'POST /add-items/bulk ({count} rows)')
+    for name, kwargs in (('json', {'json': {'key': key, 'items': rows}}),
+                         ('csv', {'data': csv_body, 'content_type': 'text/csv',
+                                  'query_string': {'key': key}})):
+        start = time.perf_counter()
+        result = client.post('/add-items/bulk', **kwargs).get_json()
+        elapsed = time.perf_counter() - start
+        print(f"  {name}: {result['inserted']} rows in {elapsed:.2f}s "
+              f'({count / elapsed * 60:,.0f} rows/min)')
+
+
+def seed_history(items, days=365):
+    # Items and one sale per item spread evenly over the last ``days`` days
+    with sqlite3.connect('inventory.db') as conn:
+        conn.executemany('''
+            INSERT INTO items (item, quantity, batch_no, manufacture_date, expiry_date, dealer_name, price, added_date)
+            VALUES (?, 100, ?, '2024-01-01', '2026-01-01', ?, 10, datetime('now', ?))
+        ''', ((f'item {i % 500}', f'B{i}', f'dealer {i % 20}', f'-{i % days} days')
+              for i in range(items)))
+        conn.executemany('INSERT INTO customers (name, phone_no, address) VALUES (?, ?, ?)',
+                         ((f'customer {i}', f'98{i:08d}', 'address') for i in range(1000)))
+        conn.executemany('''
+            INSERT INTO sales (product_id, customer_id, quantity, total_price, sale_date)
+            VALUES (?, ?, 1, 10, datetime('now', ?))
+        ''', ((i + 1, i % 1000 + 1, f'-{i % days} days') for i in range(items)))
+
+
+def bench_report(args):
+    import auth
+    client = auth.create_app().test_client()
+    key = login(client)
+    items = args.items or 100000
+    seed_history(items)
+
+    days = [(date.today() - timedelta(days=offset)).isoformat() for offset in range(0, 365, 12)]
+    start = time.perf_counter()
+    for day in days:
+        client.get('/daily-report', query_string={'key': key, 'date': day})
+    elapsed = (time.perf_counter() - start) / len(days) * 1000
+    print(f'GET /daily-report ({items} items and sales over a year)')
+    print(f'  {elapsed:.2f} ms per day')
+
+    print('GET /report over the whole year')
+    for group_by in ('day', 'week', 'month', 'item', 'dealer', 'customer'):
+        start = time.perf_counter()
+        client.get('/report', query_string={'key': key, 'group_by': group_by,
+                                            'start_date': days[-1], 'end_date': days[0]})
+        print(f'  group_by={group_by}: {(time.perf_counter() - start) * 1000:.2f} ms')
+
+
+def bench_notify(args):
+    import auth
+    app = auth.create_app()
+    bus = auth.notification_bus
+    bus.poll_interval = 0.2
+    subscribers = args.subscribers
+    keys = [f'S{i:07d}' for i in range(subscribers)]
+    with sqlite3.connect('login_notification_data.db') as conn:
+        conn.executemany('INSERT INTO login_key(user, key) VALUES (?, ?)',
+                         (('bench', key) for key in keys))
+
+    results = {}
+
+    def wait(key):
+        client = app.test_client()
+        response = client.get('/notifications/stream', query_string={'key': key, 'timeout': 30})
+        results[key] = (time.perf_counter(), response.get_json())
+
+    threading.stack_size(256 * 1024)
+    pool = [threading.Thread(target=wait, args=(key,)) for key in keys]
+    for thread in pool:
+        thread.start()
+    while bus.subscriber_count() < subscribers:
+        time.sleep(0.05)
+
+    # Idle: every client is parked, the watcher should not query for rows
+    polls, queries = bus.polls, bus.queries
+    time.sleep(args.seconds)
+    idle_polls, idle_queries = bus.polls - polls, bus.queries - queries
+
+    sent = time.perf_counter()
+    with sqlite3.connect('login_notification_data.db') as conn:
+        conn.executemany('INSERT INTO notifications (title, body, status, key) VALUES (?, ?, 0, ?)',
+                         ((f'to {key}', 'bench', key) for key in keys))
+    for thread in pool:
+        thread.join()
+
+    delivered = sum(1 for key, (_, body) in results.items()
+                    if isinstance(body, list) and [n['title'] for n in body] == [f'to {key}'])
+    latencies = sorted(done - sent for done, _ in results.values())
+    print(f'/notifications/stream with {subscribers} idle long-poll clients')
+    print(f'  idle {args.seconds:.0f}s: {idle_polls} data_version checks, {idle_queries} row queries')
+    print(f'  delivered correctly: {delivered}/{subscribers}')
+    print(f'  delivery latency p50 {latencies[len(latencies) // 2] * 1000:.0f} ms, '
+          f'max {latencies[-1] * 1000:.0f} ms')
+
+
+def bench_broadcast(args):
+    import add_notify
+    import auth
+    auth.create_database_and_tables()
+    keys = args.keys or 100000
+    with sqlite3.connect('login_notification_data.db') as conn:
+        conn.executemany('INSERT INTO login_key(user, key) VALUES (?, ?)',
+                         (('bench', f'K{i:07d}') for i in range(keys)))
+
+    # The old per-key loop is timed on a sample and extrapolated
+    sample = add_notify.get_all_keys()[:1000]
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        for key in sample:
+            add_notify.insert_notification('title', 'body', key)
+    per_key = (time.perf_counter() - start) / len(sample)
+
+    start = time.perf_counter()
+    sent = add_notify.broadcast('title', 'body')
+    elapsed = time.perf_counter() - start
+    print(f'Broadcast to {keys} keys')
+    print(f'  per-key connections: {per_key * keys:8.2f} s (extrapolated from {len(sample)} keys)')
+    print(f'  single transaction:  {elapsed:8.2f} s ({sent} notifications)')
+
+
+BENCHMARKS = {
+    'pool': bench_pool,
+    'verify_key': bench_verify_key,
+    'stream': bench_stream,
+    'sell': bench_sell,
+    'bulk': bench_bulk,
+    'report': bench_report,
+    'notify': bench_notify,
+    'broadcast': bench_broadcast,
+    'micro': bench_micro,
+    'oversell': bench_oversell,
+    'writer': bench_writer,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the inventory API')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--items', type=int,
+                        help='rows in items (default depends on the benchmark)')
+    parser.add_argument('--keys', type=int,
+                        help='stored login keys (default depends on the benchmark)')
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--sells', type=int, default=5000, help='sale attempts (oversell)')
+    parser.add_argument('--processes', type=int, default=4, help='forked processes (oversell)')
+    parser.add_argument('--data', help='directory made by datagen.py (micro)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON (micro)')
+    args = parser.parse_args()
+
+    workdir = setup_workdir()
+    try:
+        BENCHMARKS[args.benchmark](args)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
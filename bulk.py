@@ -0,0 +1,57 @@
+import csv
+import io
+import itertools
+
+# Fields of one item row, as sent to /add-item
+ITEM_FIELDS = ['item', 'quantity', 'batchNo',
+               'manufactureDate', 'expiryDate', 'dealerName', 'price']
+
+# Rows written per transaction by the bulk import
+BULK_CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000
+
+
+def parse_int(value):
+    # An integer from JSON or CSV text, or None; bools and numbers with a
+    # fraction are refused rather than truncated
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_item(row):
+    # Returns (values, None) ready for INSERT INTO items, or (None, error)
+    if not isinstance(row, dict):
+        return None, 'row must be an object'
+    missing_fields = [field for field in ITEM_FIELDS
+                      if row.get(field) is None or row.get(field) == '']
+    if missing_fields:
+        return None, f'Missing fields: {", ".join(missing_fields)}'
+    quantity = parse_int(row['quantity'])
+    price = parse_int(row['price'])
+    if quantity is None or price is None:
+        return None, 'quantity and price must be integers'
+    if quantity < 0:
+        return None, 'quantity must not be negative'
+    return (str(row['item']), quantity, str(row['batchNo']), str(row['manufactureDate']),
+            str(row['expiryDate']), str(row['dealerName']), price), None
+
+
+def csv_rows(stream):
+    # Rows of an uploaded CSV file; the header line names the ITEM_FIELDS
+    return csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+
+
+def chunks(rows, size=BULK_CHUNK_SIZE):
+    # Yield lists of (row_number, row) with at most ``size`` entries
+    numbered = enumerate(rows, start=1)
+    while True:
+        chunk = list(itertools.islice(numbered, size))
+        if not chunk:
+            return
+        yield chunk
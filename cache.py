@@ -0,0 +1,212 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single server process, threads only
+    fcntl = None
+
+# Defaults for the API key cache
+KEY_CACHE_SIZE = 10000
+KEY_CACHE_TTL = 60
+KEY_CACHE_NEGATIVE_TTL = 5
+
+# Defaults for the response cache
+RESPONSE_CACHE_SIZE = 256
+SHARED_VERSION_SLOTS = 64
+
+
+class KeyCache:
+    """Bounded LRU of API key lookups with a TTL.
+
+    Both valid and invalid keys are cached; invalid keys use a shorter TTL so
+    a key created by another process is picked up quickly. ``version`` is a
+    callable returning a counter bumped whenever keys are deleted anywhere
+    (e.g. a SharedVersions slot); entries cached under an older value are
+    looked up again, so a revoked key stops verifying in every worker.
+    """
+
+    def __init__(self, maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL,
+                 negative_ttl=KEY_CACHE_NEGATIVE_TTL, clock=time.monotonic, version=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._version = version or (lambda: None)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        # Returns True/False for a cached key, None when it must be looked up
+        version = self._version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                valid, expires, entry_version = entry
+                if expires > self._clock() and entry_version == version:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return valid
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, valid, ttl=None):
+        # ``ttl`` shortens the default, e.g. for a key about to expire
+        default_ttl = self.ttl if valid else self.negative_ttl
+        ttl = default_ttl if ttl is None else min(ttl, default_ttl)
+        version = self._version()
+        with self._lock:
+            self._entries[key] = (valid, self._clock() + ttl, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys=None):
+        # Drop the given keys, or every cached key when none are given
+        with self._lock:
+            if keys is None:
+                self._entries.clear()
+                return
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SharedVersions:
+    """Per-table version counters in a small memory-mapped file.
+
+    Every worker process on the host maps the same file, so a write in one
+    worker invalidates cached responses in all of them. Reading a version is
+    a memory access; bumping takes an exclusive flock. Tables are hashed to
+    slots, and a collision only costs an extra cache miss.
+    """
+
+    def __init__(self, path, slots=SHARED_VERSION_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        # flock is held per open file, so each forked process opens its own
+        self._pid = os.getpid()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < self.slots * 8:
+            os.ftruncate(self._fd, self.slots * 8)
+        self._map = mmap.mmap(self._fd, self.slots * 8)
+
+    def _offset(self, table):
+        return zlib.crc32(table.encode()) % self.slots * 8
+
+    def get(self, tables):
+        return tuple(struct.unpack_from('<Q', self._map, self._offset(table))[0]
+                     for table in tables)
+
+    def bump(self, tables):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                for table in tables:
+                    offset = self._offset(table)
+                    value = struct.unpack_from('<Q', self._map, offset)[0]
+                    struct.pack_into('<Q', self._map, offset, value + 1)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class ResponseCache:
+    """LRU of rendered GET responses, invalidated by per-table versions.
+
+    Writers call ``bump`` for every table they change; an entry is only
+    served while the versions of the tables it was built from are unchanged.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._shared = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.bytes_saved = 0
+
+    def share_versions(self, path):
+        # Keep versions in ``path`` so every worker process sees every write
+        with self._lock:
+            self._shared = SharedVersions(path)
+            self._entries.clear()
+
+    def versions(self, tables):
+        if self._shared is not None:
+            return self._shared.get(tables)
+        with self._lock:
+            return tuple(self._versions.get(table, 0) for table in tables)
+
+    def bump(self, *tables):
+        if self._shared is not None:
+            self._shared.bump(tables)
+            return
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def get(self, key, versions):
+        # Returns (body, etag, mimetype) or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == versions:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1:]
+            self.misses += 1
+            return None
+
+    def put(self, key, versions, body, mimetype):
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            self._entries[key] = (versions, body, etag, mimetype)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return body, etag, mimetype
+
+    def record_not_modified(self, size):
+        with self._lock:
+            self.not_modified += 1
+            self.bytes_saved += size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'not_modified': self.not_modified,
+                'bytes_saved': self.bytes_saved,
+            }
@@ -0,0 +1,82 @@
+import logging
+import re
+
+import reports
+
+# Customers are identified by their phone number, normalized to its digits
+# without the country code, so '+977 980-0000000' and '9800000000' are the
+# same buyer. Customers without a usable number are never merged.
+COUNTRY_CODE = '977'
+LOCAL_NUMBER_LENGTH = 10
+
+ADD_PHONE_KEY = [
+    'ALTER TABLE customers ADD COLUMN phone_key TEXT',
+]
+
+UNIQUE_PHONE_KEY = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_customers_phone_key ON customers(phone_key)',
+]
+
+
+def normalize_phone(phone_no):
+    digits = re.sub(r'\D', '', str(phone_no or ''))
+    if len(digits) > LOCAL_NUMBER_LENGTH and digits.startswith(COUNTRY_CODE):
+        digits = digits[len(COUNTRY_CODE):]
+    return digits or None
+
+
+def upsert(cursor, name, phone_no, address):
+    # Returns the customer id; a known phone number keeps its id and takes
+    # the latest name and address
+    cursor.execute('''
+        INSERT INTO customers (name, phone_no, address, phone_key)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (phone_key) DO UPDATE SET
+            name = excluded.name, phone_no = excluded.phone_no, address = excluded.address
+        RETURNING id
+    ''', (name, phone_no, address, normalize_phone(phone_no)))
+    return cursor.fetchone()[0]
+
+
+def merge_duplicates(cursor):
+    # Fill phone_key for existing rows, then fold every group of customers
+    # sharing a number into its oldest row, which takes the newest name and
+    # address. Sales are repointed and the rollup rebuilt to match.
+    cursor.execute('SELECT id, phone_no FROM customers')
+    cursor.executemany('UPDATE customers SET phone_key = ? WHERE id = ?',
+                       [(normalize_phone(phone_no), id) for id, phone_no in cursor.fetchall()])
+
+    cursor.execute('CREATE TEMP TABLE customer_merge (old_id INTEGER PRIMARY KEY, keep_id INTEGER)')
+    cursor.execute('''
+        INSERT INTO customer_merge (old_id, keep_id)
+        SELECT c.id, k.keep_id
+        FROM customers c
+        JOIN (SELECT phone_key, min(id) AS keep_id
+              FROM customers
+              WHERE phone_key IS NOT NULL
+              GROUP BY phone_key
+              HAVING count(*) > 1) k ON k.phone_key = c.phone_key
+        WHERE c.id != k.keep_id
+    ''')
+    cursor.execute('SELECT count(*) FROM customer_merge')
+    merged = cursor.fetchone()[0]
+    if merged:
+        cursor.execute('''
+            UPDATE customers
+            SET (name, phone_no, address) = (
+                SELECT latest.name, latest.phone_no, latest.address
+                FROM customers latest
+                WHERE latest.phone_key = customers.phone_key
+                ORDER BY latest.id DESC
+                LIMIT 1)
+            WHERE id IN (SELECT DISTINCT keep_id FROM customer_merge)
+        ''')
+        cursor.execute('''
+            UPDATE sales
+            SET customer_id = (SELECT keep_id FROM customer_merge WHERE old_id = sales.customer_id)
+            WHERE customer_id IN (SELECT old_id FROM customer_merge)
+        ''')
+        cursor.execute('DELETE FROM customers WHERE id IN (SELECT old_id FROM customer_merge)')
+        reports.rebuild_rollup(cursor)
+    cursor.execute('DROP TABLE customer_merge')
+    logging.info(f'Merged {merged} duplicate customers')
@@ -0,0 +1,147 @@
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from array import array
+from datetime import date, timedelta
+
+import db
+
+# Rows per executemany call while generating
+GENERATE_BATCH_SIZE = 50000
+# Page cache while generating; large enough to keep the indexes in memory
+GENERATE_CACHE_KIB = 512 * 1024
+
+
+def batches(rows, size=GENERATE_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert_all(cursor, query, rows):
+    for batch in batches(rows):
+        cursor.executemany(query, batch)
+
+
+def generate(items=100000, sales=200000, customers=10000, dealers=100, keys=100,
+             days=365, seed=0):
+    """Fill the databases in the current directory with synthetic data.
+
+    The same arguments always produce the same rows. Item ``n`` (id n + 1)
+    has batch number ``B<n>`` so load tests can sell it, and sales never
+    take more than an item's stock. Returns the generated login keys.
+    """
+    import auth
+    auth.create_database_and_tables()
+    rng = random.Random(seed)
+    today = date.today()
+    products = max(1, items // 5)
+
+    # Day offset (before today) each batch was added, its stock and price
+    added = array('H', (rng.randrange(days) for _ in range(items)))
+    stock = array('I', (rng.randint(50, 500) for _ in range(items)))
+    price = array('I', (rng.randint(5, 500) for _ in range(items)))
+    sold = array('I', bytes(4 * items))
+    if sales > sum(stock) // 2:
+        raise ValueError(f'{sales} sales need more than {items} items of stock')
+
+    def timestamp(offset):
+        return f'{today - timedelta(days=offset)} {rng.randrange(8, 20):02d}:{rng.randrange(60):02d}:00'
+
+    def item_rows():
+        for n in range(items):
+            made = today - timedelta(days=added[n] + rng.randint(30, 365))
+            name = f'item {rng.randrange(products)}'
+            expires = (made + timedelta(days=rng.randint(365, 1095))).isoformat()
+            yield (name, stock[n], f'B{n}', made.isoformat(), expires, expires,
+                   f'dealer {rng.randrange(dealers)}', price[n], timestamp(added[n]))
+
+    def sale_rows():
+        count = 0
+        while count < sales:
+            n = rng.randrange(items)
+            quantity = min(rng.randint(1, 5), stock[n] - sold[n])
+            if quantity <= 0:
+                continue
+            sold[n] += quantity
+            count += 1
+            yield (n + 1, rng.randint(1, customers), quantity, quantity * price[n],
+                   timestamp(rng.randint(0, added[n])))
+
+    def write(cursor):
+        insert_all(cursor, '''
+            INSERT INTO dealers (name, address, phone_no, email, panno, dd_reg, phone_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', ((f'dealer {i}', f'address {i}', f'97{i:08d}', f'dealer{i}@example.com', 100000 + i, f'DD{i}', f'97{i:08d}')
+              for i in range(dealers)))
+        insert_all(cursor, 'INSERT INTO customers (name, phone_no, address, phone_key) VALUES (?, ?, ?, ?)',
+                   ((f'customer {i}', f'98{i:08d}', f'address {i}', f'98{i:08d}') for i in range(customers)))
+        insert_all(cursor, '''
+            INSERT INTO items (item, quantity, batch_no, manufacture_date, expiry_date, expiry_day,
+                               dealer_name, price, added_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', item_rows())
+        insert_all(cursor, '''
+            INSERT INTO sales (product_id, customer_id, quantity, total_price, sale_date)
+            VALUES (?, ?, ?, ?, ?)
+        ''', sale_rows())
+        # Stock is inserted first so the rollup records what was added
+        insert_all(cursor, 'UPDATE items SET quantity = quantity - ? WHERE id = ?',
+                   ((sold[n], n + 1) for n in range(items) if sold[n]))
+
+    login_keys = [f'GEN{i:07d}' for i in range(keys)]
+    db.close_all()
+    # The file is brand new, so a crash only loses generated rows: load it
+    # without a journal, then switch back to WAL
+    conn = sqlite3.connect(db.INVENTORY_DB)
+    try:
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute(f'PRAGMA cache_size=-{GENERATE_CACHE_KIB}')
+        with conn:
+            write(conn.cursor())
+        conn.execute('PRAGMA journal_mode=WAL')
+    finally:
+        conn.close()
+    db.write(db.NOTIFICATION_DB, lambda cursor: cursor.executemany(
+        'INSERT INTO login_key(user, key) VALUES (?, ?)',
+        ((auth.valid_email, key) for key in login_keys)))
+    db.close_all()
+    return login_keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build databases filled with synthetic data')
+    parser.add_argument('directory', help='where to create inventory.db and login_notification_data.db')
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--sales', type=int, default=200000)
+    parser.add_argument('--customers', type=int, default=10000)
+    parser.add_argument('--dealers', type=int, default=100)
+    parser.add_argument('--keys', type=int, default=100, help='login keys to create')
+    parser.add_argument('--days', type=int, default=365, help='days of history')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Never add synthetic rows to an existing database
+    os.makedirs(args.directory, exist_ok=True)
+    for name in (db.INVENTORY_DB, db.NOTIFICATION_DB):
+        if os.path.exists(os.path.join(args.directory, name)):
+            sys.exit(f'{os.path.join(args.directory, name)} already exists')
+    os.chdir(args.directory)
+
+    start = time.perf_counter()
+    generate(args.items, args.sales, args.customers, args.dealers, args.keys, args.days, args.seed)
+    print(f'Generated {args.items} items, {args.sales} sales, {args.customers} customers, '
+          f'{args.dealers} dealers and {args.keys} login keys in {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+import logging
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+INVENTORY_DB = 'inventory.db'
+NOTIFICATION_DB = 'login_notification_data.db'
+
+# Connection settings shared by every pooled connection
+POOL_SIZE = 8
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 256
+
+# Most write jobs committed together by a writer thread
+WRITE_BATCH_SIZE = 64
+
+# A write that still gets SQLITE_BUSY after busy_timeout is retried this many
+# times, sleeping WRITE_BACKOFF seconds doubled per attempt, with jitter
+WRITE_RETRIES = 4
+WRITE_BACKOFF = 0.05
+
+# Class of every connection opened here; replaced by use_connection_class()
+_connection_class = sqlite3.Connection
+
+
+def open_connection(path, read_only=False):
+    if read_only:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True,
+                               timeout=BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=STATEMENT_CACHE_SIZE,
+                               check_same_thread=False, factory=_connection_class)
+    else:
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=STATEMENT_CACHE_SIZE,
+                               check_same_thread=False, factory=_connection_class)
+        conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    return conn
+
+
+def init_file(path):
+    # Create the database file with incremental auto_vacuum, so
+    # maintenance.incremental_vacuum can give space back. It can only be
+    # chosen before WAL is turned on and the first table created; an
+    # existing file is left as it is.
+    if os.path.exists(path) and os.path.getsize(path):
+        return
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+    finally:
+        conn.close()
+
+
+def is_busy(error):
+    # SQLITE_BUSY / SQLITE_LOCKED, including extended codes
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (5, 6)
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+def backoff(attempt):
+    time.sleep(WRITE_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+class ConnectionPool:
+    """Bounded pool of reusable connections to a single database file.
+
+    A connection is handed to one thread at a time, so the statement cache
+    of each connection is reused across requests instead of being rebuilt
+    by a fresh ``sqlite3.connect`` call.
+    """
+
+    def __init__(self, path, size=POOL_SIZE, read_only=False):
+        self.path = path
+        self.size = size
+        self.read_only = read_only
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self.opened = 0
+
+    @contextmanager
+    def connection(self):
+        # Same semantics as ``with sqlite3.connect(...) as conn``: commit on
+        # success, rollback on error, but the connection is kept open.
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = open_connection(self.path, self.read_only)
+                self.opened += 1
+            try:
+                with conn:
+                    yield conn
+            finally:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+                self.opened -= 1
+            except queue.Empty:
+                break
+
+    def stats(self):
+        idle = self._idle.qsize()
+        return {'size': self.size, 'open': self.opened, 'idle': idle, 'in_use': self.opened - idle}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+_writers = {}
+# Set by use_writer_threads(): pools become read-only and every write goes
+# through one writer thread per database
+_writer_mode = False
+# Connections inherited from a parent process are kept referenced but never
+# used or closed: SQLite connections must not cross a fork
+_inherited = []
+
+
+def get_pool(path):
+    global _pools_pid
+    if _pools_pid != os.getpid():
+        with _pools_lock:
+            if _pools_pid != os.getpid():
+                _inherited.append(dict(_pools))
+                _pools.clear()
+                _writers.clear()
+                _pools_pid = os.getpid()
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(path)
+            if pool is None:
+                pool = _pools[path] = ConnectionPool(path, read_only=_writer_mode)
+    return pool
+
+
+def inventory():
+    return get_pool(INVENTORY_DB).connection()
+
+
+def notifications():
+    return get_pool(NOTIFICATION_DB).connection()
+
+
+class Writer:
+    """Single thread owning the only write connection to a database.
+
+    Jobs are callables taking a cursor. Whatever is queued while a commit is
+    in progress is run in the next transaction, each job inside its own
+    savepoint, and committed together (group commit). A failing job is
+    rolled back to its savepoint without affecting the others.
+    """
+
+    def __init__(self, path, max_batch=WRITE_BATCH_SIZE):
+        self.path = path
+        self.max_batch = max_batch
+        self._jobs = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.commits = 0
+        self.jobs = 0
+
+    def submit(self, func):
+        future = Future()
+        self._jobs.put((func, future))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name=f'writer-{self.path}', daemon=True)
+                    self._thread.start()
+        return future
+
+    def _next_batch(self):
+        batch = [self._jobs.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = open_connection(self.path)
+        cursor = conn.cursor()
+        while True:
+            batch = self._next_batch()
+            results = []
+            try:
+                # Another process (add_notify.py, a second server) may hold the lock
+                for attempt in range(WRITE_RETRIES + 1):
+                    try:
+                        cursor.execute('BEGIN IMMEDIATE')
+                        break
+                    except sqlite3.OperationalError as e:
+                        if attempt == WRITE_RETRIES or not is_busy(e):
+                            raise
+                        backoff(attempt)
+                for func, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    cursor.execute('SAVEPOINT job')
+                    try:
+                        result = func(cursor)
+                    except Exception as e:
+                        cursor.execute('ROLLBACK TO job')
+                        cursor.execute('RELEASE job')
+                        results.append((future, None, e))
+                        continue
+                    cursor.execute('RELEASE job')
+                    results.append((future, result, None))
+                conn.commit()
+            except sqlite3.Error as e:
+                logging.error(f"SQLite error in writer for '{self.path}': {e}")
+                if conn.in_transaction:
+                    conn.rollback()
+                for func, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.commits += 1
+            self.jobs += len(results)
+            # Callers only see results once they are committed
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+
+def use_writer_threads():
+    global _writer_mode
+    with _pools_lock:
+        _writer_mode = True
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def write(path, func):
+    # Run func(cursor) in a write transaction and return its result. Raising
+    # from func rolls its changes back. func is run again if the database
+    # stays busy, so it must not have side effects outside the transaction.
+    if _writer_mode:
+        get_pool(path)  # resets state inherited across a fork
+        writer = _writers.get(path)
+        if writer is None:
+            with _pools_lock:
+                writer = _writers.setdefault(path, Writer(path))
+        return writer.submit(func).result()
+    for attempt in range(WRITE_RETRIES + 1):
+        try:
+            with get_pool(path).connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                return func(cursor)
+        except sqlite3.OperationalError as e:
+            if attempt == WRITE_RETRIES or not is_busy(e):
+                raise
+            logging.warning(f"'{path}' is busy, retrying write (attempt {attempt + 1})")
+            backoff(attempt)
+
+
+def use_connection_class(connection_class):
+    # Connections already in the pools keep their class, so drop them
+    global _connection_class
+    _connection_class = connection_class
+    close_all()
+
+
+def pool_stats():
+    return {path: pool.stats() for path, pool in list(_pools.items())}
+
+
+def writer_stats():
+    return {path: {'commits': writer.commits, 'jobs': writer.jobs}
+            for path, writer in list(_writers.items())}
+
+
+def close_all():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
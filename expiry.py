@@ -0,0 +1,206 @@
+import argparse
+import calendar
+import logging
+import sys
+from datetime import date, datetime, timedelta
+
+import db
+
+# items.expiry_date is whatever the client sent ('2026-01-31', '31/01/2026',
+# 'Jan 2026', '01/26', or the app's DateTime.toIso8601String()
+# '2026-01-31T00:00:00.000', ...). expiry_day holds it as an ISO date so it can be
+# indexed and compared; NULL when the text could not be understood.
+
+ADD_EXPIRY_DAY = [
+    'ALTER TABLE items ADD COLUMN expiry_day TEXT',
+]
+
+INDEX_EXPIRY_DAY = [
+    # /products/expiring: stock by expiry date
+    'CREATE INDEX IF NOT EXISTS idx_items_expiry_day ON items(expiry_day)',
+    # FEFO: the batches of one item, earliest expiry first
+    'CREATE INDEX IF NOT EXISTS idx_items_item_expiry_day ON items(item, expiry_day)',
+]
+
+# Day-first formats are tried before month-first ones
+DAY_FORMATS = ['%Y-%m-%d', '%Y/%m/%d', '%d-%m-%Y', '%d/%m/%Y', '%d.%m.%Y', '%d %b %Y', '%d %B %Y']
+# A month without a day expires at the end of that month
+MONTH_FORMATS = ['%Y-%m', '%Y/%m', '%m-%Y', '%m/%Y', '%m/%y', '%m-%y', '%m.%Y',
+                 '%b %Y', '%b-%Y', '%b/%Y', '%B %Y']
+
+# What clients send, and the day each must be read as (expiry.py --check)
+EXAMPLES = [
+    ('2024-09-27T00:00:00.000', '2024-09-27'),  # the Flutter app
+    ('2024-09-27 00:00:00', '2024-09-27'),
+    ('2024-09-27T00:00:00Z', '2024-09-27'),
+    ('2024-09-27', '2024-09-27'),
+    ('27/09/2024', '2024-09-27'),
+    ('27 Sep 2024', '2024-09-27'),
+    ('Sep 2024', '2024-09-30'),
+    ('09/24', '2024-09-30'),
+    ('soon', None),
+]
+
+DEFAULT_ALERT_DAYS = 30
+# Batches named in one alert; the rest are only counted
+MAX_ALERT_ITEMS = 10
+
+
+def normalize_date(text):
+    # Returns 'YYYY-MM-DD' or None
+    text = ' '.join(str(text or '').split())
+    if not text:
+        return None
+    # ISO dates and date-times; the day is the one written, whatever the offset
+    try:
+        return datetime.fromisoformat(text).date().isoformat()
+    except ValueError:
+        pass
+    for fmt in DAY_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            pass
+    for fmt in MONTH_FORMATS:
+        try:
+            month = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        last_day = calendar.monthrange(month.year, month.month)[1]
+        return date(month.year, month.month, last_day).isoformat()
+    return None
+
+
+def fill_expiry_day(cursor, missing_only=False):
+    # ``missing_only`` re-reads just the rows an older normalize_date gave up on
+    cursor.execute('SELECT id, expiry_date FROM items'
+                   + (' WHERE expiry_day IS NULL' if missing_only else ''))
+    rows = [(normalize_date(expiry_date), id) for id, expiry_date in cursor.fetchall()]
+    cursor.executemany('UPDATE items SET expiry_day = ? WHERE id = ?', rows)
+    unknown = sum(1 for expiry_day, _ in rows if expiry_day is None)
+    if unknown:
+        logging.warning(f'{unknown} item(s) have an expiry date that could not be read')
+
+
+def expiring_query(limit=None):
+    # Batches in stock that expire on or before the first parameter,
+    # including ones that already have
+    query = '''
+        SELECT id, item, batch_no, quantity, expiry_date, expiry_day
+        FROM items
+        WHERE expiry_day <= ? AND quantity > 0
+        ORDER BY expiry_day, id
+    '''
+    if limit is not None:
+        query += ' LIMIT ?'
+    return query
+
+
+BATCHES_QUERY = '''
+    SELECT b.id, b.batch_no, b.quantity
+    FROM items p
+    JOIN items b ON b.item = p.item
+    WHERE p.id = ? AND b.quantity > 0 AND (b.expiry_day IS NULL OR b.expiry_day >= ?)
+    ORDER BY b.expiry_day IS NULL, b.expiry_day, b.id
+'''
+
+
+def allocate(cursor, lines, today=None):
+    """Choose batches first-expired-first-out for sale lines without one.
+
+    ``lines`` are (product_id, batch_no, quantity, total_price) tuples; a
+    line with batch_no None takes its quantity from the unexpired batches of
+    the same item as product_id, soonest expiry first, split over several
+    batches if needed with the price shared by quantity. Batches without a
+    readable expiry date go last. Returns (lines, short) where short lists
+    the product ids that could not be covered.
+    """
+    today = (today or date.today()).isoformat()
+    # Stock already claimed by earlier lines of the same sale
+    taken = {}
+    for product_id, batch_no, quantity, _ in lines:
+        if batch_no is not None:
+            taken[product_id] = taken.get(product_id, 0) + quantity
+
+    allocated = []
+    short = []
+    for product_id, batch_no, quantity, total_price in lines:
+        if batch_no is not None:
+            allocated.append((product_id, batch_no, quantity, total_price))
+            continue
+        picks = []
+        needed = quantity
+        cursor.execute(BATCHES_QUERY, (product_id, today))
+        for id, batch, available in cursor:
+            take = min(needed, available - taken.get(id, 0))
+            if take > 0:
+                picks.append((id, batch, take))
+                needed -= take
+                if not needed:
+                    break
+        if needed:
+            short.append((product_id, None))
+            continue
+        remaining = total_price
+        for index, (id, batch, take) in enumerate(picks):
+            taken[id] = taken.get(id, 0) + take
+            price = remaining if index == len(picks) - 1 else round(total_price * take / quantity, 2)
+            remaining -= price
+            allocated.append((id, batch, take, price))
+    return allocated, short
+
+
+def alert(within_days=DEFAULT_ALERT_DAYS, today=None):
+    # Notify every login key of the batches in stock expiring within
+    # ``within_days``. Returns the number of batches found.
+    import add_notify
+    today = today or date.today()
+    with db.inventory() as conn:
+        cursor = conn.cursor()
+        cursor.execute(expiring_query(), ((today + timedelta(days=within_days)).isoformat(),))
+        rows = cursor.fetchall()
+    if not rows:
+        return 0
+
+    lines = [f'{item} (batch {batch_no}, {quantity} left) expires {expiry_day}'
+             for _, item, batch_no, quantity, _, expiry_day in rows[:MAX_ALERT_ITEMS]]
+    if len(rows) > MAX_ALERT_ITEMS:
+        lines.append(f'and {len(rows) - MAX_ALERT_ITEMS} more')
+    add_notify.broadcast(f'{len(rows)} batch(es) expire within {within_days} days', '\n'.join(lines))
+    return len(rows)
+
+
+def fill_missing_expiry_day(cursor):
+    fill_expiry_day(cursor, missing_only=True)
+
+
+def check():
+    # Returns the EXAMPLES that normalize_date reads wrongly
+    return [(text, expected, normalize_date(text)) for text, expected in EXAMPLES
+            if normalize_date(text) != expected]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Notify users of stock that is about to expire')
+    parser.add_argument('--within-days', type=int, default=DEFAULT_ALERT_DAYS)
+    parser.add_argument('--check', action='store_true',
+                        help='check that the expiry dates clients send are understood, then exit')
+    args = parser.parse_args()
+
+    if args.check:
+        failures = check()
+        for text, expected, got in failures:
+            print(f'{text!r}: expected {expected}, got {got}')
+        if failures:
+            sys.exit(1)
+        print(f'All {len(EXAMPLES)} example expiry dates understood.')
+        return
+
+    import auth
+    auth.create_database_and_tables()
+    count = alert(args.within_days)
+    print(f'{count} batch(es) in stock expire within {args.within_days} days.')
+
+
+if __name__ == '__main__':
+    main()
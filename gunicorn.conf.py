@@ -0,0 +1,23 @@
+import multiprocessing
+import os
+
+# Settings for ``gunicorn -c gunicorn.conf.py wsgi:app``; every value can be
+# overridden with an SVP_* environment variable
+bind = os.environ.get('SVP_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('SVP_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('SVP_THREADS', 4))
+# Long-polling /notifications/stream holds requests for up to a minute
+timeout = 90
+# Maintenance jobs are off unless SVP_SCHEDULER=1 (see wsgi.py). With it,
+# every worker starts a scheduler thread and each due job is claimed and run
+# by one of them.
+
+
+def on_starting(server):
+    # Create tables and run migrations once in the master, not in every worker
+    import auth
+    import db
+    auth.create_database_and_tables()
+    db.close_all()
+    os.environ['SVP_INIT_DB'] = '0'
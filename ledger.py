@@ -0,0 +1,262 @@
+import argparse
+import logging
+import sys
+from datetime import date, datetime, timedelta, timezone
+
+import db
+
+# stock_ledger is the append-only history of every stock movement: one
+# 'receipt' per item batch added, one 'sale' per sales row and any manual
+# 'adjustment'. quantity is the signed change. items.quantity stays the
+# materialized balance of each batch and is updated in the same
+# transaction, so current stock is a primary key lookup. stock_snapshots
+# checkpoints the balances at the end of a day so stock at a past date only
+# needs the ledger entries since the nearest snapshot.
+#
+# Timestamps are UTC like the other CURRENT_TIMESTAMP columns.
+
+CREATE_LEDGER = [
+    '''
+    CREATE TABLE IF NOT EXISTS stock_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        sale_id INTEGER,
+        note TEXT,
+        created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS stock_snapshots (
+        day TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (day, product_id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_stock_ledger_append_only BEFORE UPDATE ON stock_ledger
+    BEGIN
+        SELECT RAISE(ABORT, 'stock_ledger is append-only');
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_items_stock_ledger AFTER INSERT ON items
+    BEGIN
+        INSERT INTO stock_ledger (product_id, kind, quantity, created)
+        VALUES (NEW.id, 'receipt', coalesce(NEW.quantity, 0), coalesce(NEW.added_date, CURRENT_TIMESTAMP));
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_sales_stock_ledger AFTER INSERT ON sales
+    BEGIN
+        INSERT INTO stock_ledger (product_id, kind, quantity, sale_id, created)
+        VALUES (NEW.product_id, 'sale', -coalesce(NEW.quantity, 0), NEW.id,
+                coalesce(NEW.sale_date, CURRENT_TIMESTAMP));
+    END
+    ''',
+]
+
+# Created after fill_ledger: building them over the filled table is much
+# faster than updating them row by row
+INDEX_LEDGER = [
+    'CREATE INDEX IF NOT EXISTS idx_stock_ledger_product ON stock_ledger(product_id, created)',
+    'CREATE INDEX IF NOT EXISTS idx_stock_ledger_created ON stock_ledger(created)',
+]
+
+MAX_REPORTED_MISMATCHES = 20
+
+
+def fill_ledger(cursor):
+    # Ledger entries for the existing history. Sales decrement
+    # items.quantity, so a batch received what is left plus what it sold.
+    cursor.execute('''
+        INSERT INTO stock_ledger (product_id, kind, quantity, created)
+        SELECT i.id, 'receipt',
+               coalesce(i.quantity, 0) + coalesce((SELECT sum(s.quantity) FROM sales s WHERE s.product_id = i.id), 0),
+               coalesce(i.added_date, CURRENT_TIMESTAMP)
+        FROM items i
+        ORDER BY i.id
+    ''')
+    cursor.execute('''
+        INSERT INTO stock_ledger (product_id, kind, quantity, sale_id, created)
+        SELECT s.product_id, 'sale', -coalesce(s.quantity, 0), s.id, coalesce(s.sale_date, CURRENT_TIMESTAMP)
+        FROM sales s
+        WHERE s.product_id IN (SELECT id FROM items)
+        ORDER BY s.id
+    ''')
+
+
+def adjust(cursor, product_id, batch_no, quantity, note=None):
+    # Returns the new balance, or None when the batch does not exist or
+    # would go below zero
+    cursor.execute('''
+        UPDATE items
+        SET quantity = quantity + ?
+        WHERE id = ? AND batch_no = ? AND quantity + ? >= 0
+        RETURNING quantity
+    ''', (quantity, product_id, batch_no, quantity))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    cursor.execute(
+        "INSERT INTO stock_ledger (product_id, kind, quantity, note) VALUES (?, 'adjustment', ?, ?)",
+        (product_id, quantity, note))
+    return row[0]
+
+
+def clear(cursor):
+    # /clear-data removed every item, so their history goes too
+    cursor.execute('DELETE FROM stock_ledger')
+    cursor.execute('DELETE FROM stock_snapshots')
+
+
+def utc_today():
+    return datetime.now(timezone.utc).date()
+
+
+def next_day(day):
+    # The ledger range of ``day`` is [day, next_day); timestamps compare as text
+    return (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+
+
+def snapshot_before(cursor, day):
+    # Day of the latest snapshot taken before ``day``, or None
+    cursor.execute('SELECT max(day) FROM stock_snapshots WHERE day < ?', (day,))
+    return cursor.fetchone()[0]
+
+
+def balances_query(product_filter=''):
+    # Balances at the end of a day: a snapshot (day) plus the ledger
+    # entries in [start, end)
+    return f'''
+        SELECT product_id, sum(quantity) AS quantity
+        FROM (SELECT product_id, quantity FROM stock_snapshots WHERE day = ? {product_filter}
+              UNION ALL
+              SELECT product_id, quantity FROM stock_ledger
+              WHERE created >= ? AND created < ? {product_filter})
+        GROUP BY product_id
+    '''
+
+
+def stock_at(cursor, day, product_id=None):
+    # {product_id: quantity} at the end of ``day`` (YYYY-MM-DD)
+    base = snapshot_before(cursor, next_day(day))
+    start = next_day(base) if base else ''
+    if product_id is None:
+        cursor.execute(balances_query(), (base, start, next_day(day)))
+    else:
+        cursor.execute(balances_query('AND product_id = ?'),
+                       (base, product_id, start, next_day(day), product_id))
+    return {product_id: quantity for product_id, quantity in cursor.fetchall() if quantity}
+
+
+def snapshot(cursor, day):
+    """Checkpoint every non-zero balance at the end of ``day``.
+
+    Built from the previous snapshot and the ledger entries since, so a
+    daily snapshot only reads one day of the ledger. Only finished (UTC)
+    days can be snapshotted; later entries are never dated in the past.
+    Returns the number of balances stored.
+    """
+    if day >= utc_today().isoformat():
+        raise ValueError(f'{day} has not finished yet')
+    base = snapshot_before(cursor, day)
+    cursor.execute('DELETE FROM stock_snapshots WHERE day = ?', (day,))
+    cursor.execute(f'''
+        INSERT INTO stock_snapshots (day, product_id, quantity)
+        SELECT ?, product_id, quantity
+        FROM ({balances_query()})
+        WHERE quantity != 0
+    ''', (day, base, next_day(base) if base else '', next_day(day)))
+    return cursor.rowcount
+
+
+def check(cursor):
+    """Verify the materialized balances and the latest snapshot.
+
+    Returns (what, product_id, expected, actual) for every mismatch, where
+    expected is what the ledger says.
+    """
+    mismatches = []
+    cursor.execute('''
+        SELECT i.id, coalesce(l.total, 0), i.quantity
+        FROM items i
+        LEFT JOIN (SELECT product_id, sum(quantity) AS total FROM stock_ledger GROUP BY product_id) l
+            ON l.product_id = i.id
+        WHERE coalesce(i.quantity, 0) != coalesce(l.total, 0)
+    ''')
+    mismatches.extend(('balance', product_id, expected, actual)
+                      for product_id, expected, actual in cursor.fetchall())
+    cursor.execute('''
+        SELECT product_id, sum(quantity) FROM stock_ledger
+        WHERE product_id NOT IN (SELECT id FROM items)
+        GROUP BY product_id
+    ''')
+    mismatches.extend(('missing item', product_id, expected, None)
+                      for product_id, expected in cursor.fetchall())
+
+    cursor.execute('SELECT max(day) FROM stock_snapshots')
+    day = cursor.fetchone()[0]
+    if day:
+        cursor.execute('SELECT product_id, quantity FROM stock_snapshots WHERE day = ?', (day,))
+        stored = dict(cursor.fetchall())
+        cursor.execute('''
+            SELECT product_id, sum(quantity) FROM stock_ledger
+            WHERE created < ?
+            GROUP BY product_id
+            HAVING sum(quantity) != 0
+        ''', (next_day(day),))
+        expected = dict(cursor.fetchall())
+        for product_id in sorted(stored.keys() | expected.keys()):
+            if stored.get(product_id, 0) != expected.get(product_id, 0):
+                mismatches.append((f'snapshot {day}', product_id,
+                                   expected.get(product_id, 0), stored.get(product_id, 0)))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stock ledger maintenance')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('check', help='verify balances and the latest snapshot against the ledger')
+    snapshot_parser = subparsers.add_parser('snapshot', help='checkpoint balances at the end of a day')
+    snapshot_parser.add_argument('--day', help='YYYY-MM-DD (default: yesterday, UTC)')
+    stock_parser = subparsers.add_parser('stock', help='print stock at the end of a day')
+    stock_parser.add_argument('--at', required=True, help='YYYY-MM-DD')
+    stock_parser.add_argument('--product', type=int, help='one item batch id')
+    args = parser.parse_args()
+
+    # Create the base tables and apply pending migrations first
+    import auth
+    auth.create_database_and_tables()
+
+    if args.command == 'check':
+        with db.inventory() as conn:
+            mismatches = check(conn.cursor())
+        for what, product_id, expected, actual in mismatches[:MAX_REPORTED_MISMATCHES]:
+            print(f'{what}: product {product_id} ledger {expected}, found {actual}')
+        if len(mismatches) > MAX_REPORTED_MISMATCHES:
+            print(f'... and {len(mismatches) - MAX_REPORTED_MISMATCHES} more')
+        if mismatches:
+            sys.exit(1)
+        print('Stock balances match the ledger.')
+
+    elif args.command == 'snapshot':
+        day = args.day or (utc_today() - timedelta(days=1)).isoformat()
+        try:
+            rows = db.write(db.INVENTORY_DB, lambda cursor: snapshot(cursor, day))
+        except ValueError as e:
+            sys.exit(str(e))
+        logging.info(f'Stock snapshot for {day}: {rows} balances')
+        print(f'Snapshot for {day}: {rows} balances')
+
+    else:
+        with db.inventory() as conn:
+            balances = stock_at(conn.cursor(), args.at, args.product)
+        for product_id, quantity in sorted(balances.items()):
+            print(f'{product_id}\t{quantity}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+# Drives the API over HTTP with a weighted mix of the app's calls and reports
+# throughput and p50/p95/p99 latency per endpoint. The server is gunicorn
+# (gunicorn.conf.py) or uvicorn (asgi.py) started in a scratch directory, so
+# the numbers include real process and SQLite WAL contention, or the Flask
+# test client in this process when no HTTP server is wanted. HTTP clients are
+# spread over several processes so the load generator is not held back by
+# the GIL; each process's CPU use is reported so a saturated one shows up.
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+LOGIN = {'email': 'skbd@skbd.com', 'password': 'skbd0001', 'app': 'svp_admin'}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def summarize(latencies, errors, seconds):
+    # latencies in seconds -> throughput and percentiles in milliseconds
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / seconds,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+class HTTPSession:
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+
+    def request(self, method, path, body=None):
+        # Returns (status, body); raises OSError/HTTPException after reconnecting
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        try:
+            self.conn.request(method, path, body=None if body is None else json.dumps(body),
+                              headers=headers)
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            raise
+
+    def close(self):
+        self.conn.close()
+
+
+class TestClientSession:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_data()
+
+    def close(self):
+        pass
+
+
+def start_server(workdir, port, server, workers, threads):
+    # Maintenance jobs would add load of their own
+    env = dict(os.environ, SVP_LOG_LEVEL='WARNING', SVP_SCHEDULER='0')
+    if server == 'gunicorn':
+        env.update(SVP_BIND=f'127.0.0.1:{port}', SVP_WORKERS=str(workers), SVP_THREADS=str(threads))
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+                   '--chdir', workdir, '--pythonpath', ROOT, 'wsgi:app']
+    else:
+        # asgi.py runs a single process; threads are its view handler threads
+        env.update(SVP_ASGI_THREADS=str(threads))
+        command = [sys.executable, '-m', 'uvicorn', '--app-dir', ROOT, '--host', '127.0.0.1',
+                   '--port', str(port), '--log-level', 'warning', 'asgi:app']
+    process = subprocess.Popen(command, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+
+def prepare_data(workdir, args):
+    # Copy a datagen.py directory, or generate --items items into workdir.
+    # Returns the number of items.
+    if args.data:
+        for name in ('inventory.db', 'login_notification_data.db'):
+            shutil.copy(os.path.join(args.data, name), workdir)
+    else:
+        import datagen
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            datagen.generate(items=args.items, sales=args.items * 2,
+                             customers=max(1, args.items // 10), seed=args.seed)
+        finally:
+            os.chdir(cwd)
+    with sqlite3.connect(os.path.join(workdir, 'inventory.db')) as conn:
+        return conn.execute('SELECT max(id) FROM items').fetchone()[0] or 0
+
+
+def scenario(key, items):
+    # Weighted mix of calls made by the app: mostly reads, some sales.
+    # datagen.py gives item id n + 1 batch number B<n>.
+    def login():
+        return 'POST', '/login', LOGIN
+
+    def products():
+        return 'GET', f'/products?key={key}&limit=50&after={random.randint(0, max(0, items - 50))}', None
+
+    def daily_report():
+        day = date.today() - timedelta(days=random.randrange(365))
+        return 'GET', f'/daily-report?key={key}&date={day}', None
+
+    def customer():
+        return {'key': key, 'customerName': 'load', 'phoneNo': '9800000000', 'address': 'test'}
+
+    def sell():
+        product_id = random.randint(1, items)
+        return 'POST', '/sell', {**customer(), 'productIds': [product_id],
+                                 'batchNo': [f'B{product_id - 1}'], 'quantity': 1, 'total_price': 10}
+
+    def sell_v2():
+        product_id = random.randint(1, items)
+        return 'POST', '/sell/v2', {**customer(), 'items': [
+            {'productId': product_id, 'batchNo': f'B{product_id - 1}', 'quantity': 1, 'total_price': 10}]}
+
+    def notice():
+        return 'POST', '/notice', {'key': key}
+
+    return {
+        'login': (1, login),
+        'products': (5, products),
+        'daily_report': (2, daily_report),
+        'sell': (1, sell),
+        'sell_v2': (1, sell_v2),
+        'notice': (1, notice),
+    }
+
+
+def drive(new_session, calls, clients, seconds):
+    # Returns {name: (latencies in seconds, error count)}; errors are 5xx
+    # responses and failed connections
+    names = [name for name, (weight, _) in calls.items() for _ in range(weight)]
+    stop = time.perf_counter() + seconds
+    results = {name: [[], 0] for name in calls}
+    lock = threading.Lock()
+
+    def client():
+        session = new_session()
+        mine = {name: [[], 0] for name in calls}
+        while time.perf_counter() < stop:
+            name = random.choice(names)
+            method, path, body = calls[name][1]()
+            start = time.perf_counter()
+            try:
+                status, _ = session.request(method, path, body)
+                failed = status >= 500
+            except (OSError, http.client.HTTPException):
+                failed = True
+            mine[name][0].append(time.perf_counter() - start)
+            mine[name][1] += failed
+        session.close()
+        with lock:
+            for name, (latencies, errors) in mine.items():
+                results[name][0].extend(latencies)
+                results[name][1] += errors
+
+    pool = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return results
+
+
+def drive_measured(new_session, calls, clients, seconds):
+    # drive(), plus the fraction of one CPU this process used meanwhile
+    cpu = time.process_time()
+    start = time.perf_counter()
+    results = drive(new_session, calls, clients, seconds)
+    return results, (time.process_time() - cpu) / (time.perf_counter() - start)
+
+
+def drive_http(port, key, items, clients, seconds):
+    # Runs in a client process; forked processes would otherwise all make
+    # the same random choices
+    random.seed()
+    return drive_measured(lambda: HTTPSession(port), scenario(key, items), clients, seconds)
+
+
+def drive_processes(port, key, items, clients, processes, seconds):
+    # Splits the clients over ``processes`` processes, each running drive().
+    # Returns the merged results and each process's CPU use.
+    processes = max(1, min(processes, clients))
+    shares = [clients // processes + (i < clients % processes) for i in range(processes)]
+    with multiprocessing.Pool(processes) as pool:
+        runs = pool.starmap(drive_http, [(port, key, items, share, seconds) for share in shares])
+    results = {}
+    for run_results, _ in runs:
+        for name, (latencies, errors) in run_results.items():
+            merged = results.setdefault(name, [[], 0])
+            merged[0].extend(latencies)
+            merged[1] += errors
+    return results, [cpu for _, cpu in runs]
+
+
+def run(workers, args):
+    workdir = tempfile.mkdtemp(prefix='svp-load-')
+    process = None
+    cwd = os.getcwd()
+    try:
+        items = prepare_data(workdir, args)
+        if args.server == 'test-client':
+            os.chdir(workdir)
+            import auth
+            app = auth.create_app({'LOG_LEVEL': 'WARNING', 'CACHE_VERSIONS_FILE': ''})
+            new_session = lambda: TestClientSession(app)
+        else:
+            port = free_port()
+            process = start_server(workdir, port, args.server, workers, args.threads)
+            new_session = lambda: HTTPSession(port)
+
+        session = new_session()
+        key = json.loads(session.request('POST', '/login', LOGIN)[1])['key']
+        session.close()
+        if args.server == 'test-client':
+            # The app lives in this process, so its CPU is counted too
+            results, cpu = drive_measured(new_session, scenario(key, items), args.clients, args.seconds)
+            client_cpu = [cpu]
+        else:
+            results, client_cpu = drive_processes(port, key, items, args.clients,
+                                                  args.client_processes, args.seconds)
+    finally:
+        os.chdir(cwd)
+        if process is not None:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = [latency for name_latencies, _ in results.values() for latency in name_latencies]
+    errors = sum(name_errors for _, name_errors in results.values())
+    return {
+        'server': args.server,
+        'workers': workers,
+        'threads': args.threads,
+        'clients': args.clients,
+        'client_processes': len(client_cpu),
+        'client_cpu': client_cpu,
+        'seconds': args.seconds,
+        'items': items,
+        'total': summarize(latencies, errors, args.seconds),
+        'endpoints': {name: summarize(name_latencies, name_errors, args.seconds)
+                      for name, (name_latencies, name_errors) in results.items()},
+    }
+
+
+# A client process busier than this is probably what limits throughput
+CLIENT_CPU_SATURATED = 0.9
+
+
+def print_result(result):
+    print(f"{result['server']}: {result['workers']} worker(s), {result['threads']} threads, "
+          f"{result['clients']} clients, {result['items']} items")
+    print(f"  {'endpoint':<14} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    rows = list(result['endpoints'].items()) + [('total', result['total'])]
+    for name, stats in rows:
+        print(f"  {name:<14} {stats['rps']:>9.1f} {stats['p50_ms']:>8.2f} "
+              f"{stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f} {stats['errors']:>7}")
+    busiest = max(result['client_cpu'])
+    print(f"  client CPU: {', '.join(f'{cpu:.0%}' for cpu in result['client_cpu'])} "
+          f"over {result['client_processes']} process(es)")
+    if busiest >= CLIENT_CPU_SATURATED and result['server'] != 'test-client':
+        print('  warning: a client process was CPU-bound, so these numbers may be the '
+              "load generator's limit; raise --client-processes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP load test of the inventory API')
+    parser.add_argument('--server', choices=['gunicorn', 'uvicorn', 'test-client'], default='gunicorn')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='gunicorn worker counts to compare')
+    parser.add_argument('--threads', type=int, default=4, help='threads per worker')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent HTTP clients')
+    parser.add_argument('--client-processes', type=int, default=os.cpu_count() or 1,
+                        help='processes to spread the clients over (not with test-client)')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--items', type=int, default=10000, help='items to generate')
+    parser.add_argument('--data', help='directory made by datagen.py to use instead')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    worker_counts = args.workers if args.server == 'gunicorn' else [1]
+    results = []
+    for workers in worker_counts:
+        result = run(workers, args)
+        results.append(result)
+        if not args.json:
+            print_result(result)
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
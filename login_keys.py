@@ -0,0 +1,204 @@
+import argparse
+import logging
+import secrets
+import time
+from datetime import datetime, timedelta, timezone
+
+import db
+
+# Login keys expire KEY_TTL_DAYS after login or refresh. A NULL expires_at
+# never expires (keys made by bench.py, datagen.py and test.py). Expired keys
+# and the notifications sent to them are deleted by prune() in small
+# batches, each its own short write transaction.
+
+DEFAULT_TTL_DAYS = 30
+# 24 random bytes -> 32 URL-safe characters; collisions are not a concern,
+# the unique index only guards against bugs
+KEY_BYTES = 24
+
+PRUNE_BATCH_SIZE = 500
+# Read notifications are kept this long
+READ_RETENTION_DAYS = 90
+# Pause between batches so other writers get the lock
+PRUNE_PAUSE = 0.01
+
+ADD_EXPIRY = [
+    'ALTER TABLE login_key ADD COLUMN expires_at TIMESTAMP',
+    # Keys issued before expiry existed get a full term from now rather than
+    # logging everyone out at once
+    f"UPDATE login_key SET expires_at = datetime('now', '+{DEFAULT_TTL_DAYS} days')",
+    # Short keys were only checked for uniqueness by a SELECT, so keep the
+    # first of any duplicates before adding the unique index
+    '''
+    DELETE FROM login_key
+    WHERE id NOT IN (SELECT min(id) FROM login_key GROUP BY key)
+    ''',
+    'DROP INDEX IF EXISTS idx_login_key_key',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_login_key_key ON login_key(key)',
+    'CREATE INDEX IF NOT EXISTS idx_login_key_expires_at ON login_key(expires_at)',
+]
+
+# Seconds the key has left: NULL when it never expires, no row when unknown
+SECONDS_LEFT_QUERY = '''
+    SELECT CAST((julianday(expires_at) - julianday('now')) * 86400 AS INTEGER)
+    FROM login_key
+    WHERE key = ?
+'''
+
+
+def new_key():
+    return secrets.token_urlsafe(KEY_BYTES)
+
+
+def insert_key(cursor, user, ttl_days):
+    # Returns (key, expires_at)
+    cursor.execute('''
+        INSERT INTO login_key (user, key, expires_at)
+        VALUES (?, ?, datetime('now', ?))
+        RETURNING key, expires_at
+    ''', (user, new_key(), f'+{ttl_days} days'))
+    return cursor.fetchone()
+
+
+def rotate_key(cursor, key, ttl_days):
+    # Replace a valid key by a new one, moving its notifications over.
+    # Returns (key, expires_at), or None when ``key`` is unknown or expired.
+    cursor.execute('''
+        SELECT user FROM login_key
+        WHERE key = ? AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+    ''', (key,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    new = insert_key(cursor, row[0], ttl_days)
+    cursor.execute('UPDATE notifications SET key = ? WHERE key = ?', (new[0], key))
+    cursor.execute('DELETE FROM login_key WHERE key = ?', (key,))
+    return new
+
+
+def prune_batch(cursor, batch_size):
+    # Delete up to batch_size expired keys and their notifications; returns
+    # (keys, notifications) deleted
+    cursor.execute('''
+        SELECT key FROM login_key
+        WHERE expires_at <= CURRENT_TIMESTAMP
+        LIMIT ?
+    ''', (batch_size,))
+    keys = [(key,) for key, in cursor.fetchall()]
+    cursor.executemany('DELETE FROM notifications WHERE key = ?', keys)
+    notifications = cursor.rowcount if keys else 0
+    cursor.executemany('DELETE FROM login_key WHERE key = ?', keys)
+    return [key for key, in keys], notifications
+
+
+def prune_orphans_batch(cursor, after_id, batch_size):
+    # Delete notifications among the batch_size after ``after_id`` whose key
+    # no longer exists; returns (last id examined or None at the end, deleted)
+    cursor.execute('SELECT max(id) FROM (SELECT id FROM notifications WHERE id > ? ORDER BY id LIMIT ?)',
+                   (after_id, batch_size))
+    last_id = cursor.fetchone()[0]
+    if last_id is None:
+        return None, 0
+    cursor.execute('''
+        DELETE FROM notifications
+        WHERE id > ? AND id <= ?
+          AND NOT EXISTS (SELECT 1 FROM login_key k WHERE k.key = notifications.key)
+    ''', (after_id, last_id))
+    return last_id, cursor.rowcount
+
+
+def prune(batch_size=PRUNE_BATCH_SIZE, orphans=False, on_keys=None):
+    """Delete expired login keys and their notifications.
+
+    Works in batches of ``batch_size``, each in its own write transaction,
+    so the notification database is never locked for long. With
+    ``orphans`` every notification is also checked for a key that no
+    longer exists (e.g. deleted before expiry was tracked). ``on_keys`` is
+    called with each batch of deleted keys. Returns (keys, notifications).
+    """
+    total_keys = total_notifications = 0
+    while True:
+        keys, notifications = db.write(db.NOTIFICATION_DB, lambda cursor: prune_batch(cursor, batch_size))
+        if on_keys and keys:
+            on_keys(keys)
+        total_keys += len(keys)
+        total_notifications += notifications
+        if len(keys) < batch_size:
+            break
+        time.sleep(PRUNE_PAUSE)
+
+    after_id = 0
+    while orphans and after_id is not None:
+        after_id, notifications = db.write(
+            db.NOTIFICATION_DB, lambda cursor: prune_orphans_batch(cursor, after_id, batch_size))
+        total_notifications += notifications
+        time.sleep(PRUNE_PAUSE)
+
+    if total_keys or total_notifications:
+        logging.info(f'Pruned {total_keys} expired login keys and {total_notifications} notifications')
+    return total_keys, total_notifications
+
+
+def prune_read_batch(cursor, after_id, cutoff, batch_size):
+    # Delete read notifications older than ``cutoff`` among the batch_size
+    # after ``after_id``; returns (last id examined or None when done,
+    # deleted). Ids grow with notification_date, so once a batch reaches
+    # the cutoff there is nothing older left.
+    cursor.execute('''
+        SELECT max(id), max(notification_date)
+        FROM (SELECT id, notification_date FROM notifications WHERE id > ? ORDER BY id LIMIT ?)
+    ''', (after_id, batch_size))
+    last_id, newest = cursor.fetchone()
+    if last_id is None:
+        return None, 0
+    cursor.execute('''
+        DELETE FROM notifications
+        WHERE id > ? AND id <= ? AND status = 1 AND notification_date < ?
+    ''', (after_id, last_id, cutoff))
+    deleted = cursor.rowcount
+    if newest is not None and newest >= cutoff:
+        return None, deleted
+    return last_id, deleted
+
+
+def prune_read(days=READ_RETENTION_DAYS, batch_size=PRUNE_BATCH_SIZE):
+    # Delete notifications read more than ``days`` ago (by the date they
+    # were sent) in batches like prune(); returns the number deleted
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    total = 0
+    after_id = 0
+    while after_id is not None:
+        after_id, deleted = db.write(
+            db.NOTIFICATION_DB, lambda cursor: prune_read_batch(cursor, after_id, cutoff, batch_size))
+        total += deleted
+        time.sleep(PRUNE_PAUSE)
+    if total:
+        logging.info(f'Pruned {total} read notifications older than {days} days')
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Delete expired login keys and their notifications')
+    parser.add_argument('--batch-size', type=int, default=PRUNE_BATCH_SIZE)
+    parser.add_argument('--orphans', action='store_true',
+                        help='also delete notifications whose key no longer exists')
+    parser.add_argument('--read-days', type=int,
+                        help='also delete read notifications older than this many days')
+    args = parser.parse_args()
+
+    # Create the base tables and apply pending migrations first
+    import auth
+    auth.create_database_and_tables()
+    # Keys deleted here must also drop out of the API workers' key caches
+    versions_file = auth.config_from_env().get('CACHE_VERSIONS_FILE', auth.DEFAULT_CONFIG['CACHE_VERSIONS_FILE'])
+    if versions_file:
+        auth.response_cache.share_versions(versions_file)
+    keys, notifications = prune(args.batch_size, args.orphans, on_keys=auth.revoke_keys)
+    print(f'Deleted {keys} expired login key(s) and {notifications} notification(s).')
+    if args.read_days is not None:
+        read = prune_read(args.read_days, args.batch_size)
+        print(f'Deleted {read} read notification(s) older than {args.read_days} days.')
+
+
+if __name__ == '__main__':
+    main()
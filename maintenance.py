@@ -0,0 +1,83 @@
+import glob
+import logging
+import os
+import sqlite3
+import time
+
+import db
+
+# SQLite upkeep run by scheduler.py. Each function opens its own connection
+# to the database at ``path``, so it works the same in a worker process, the
+# ASGI server (whose pools are read-only) or the command line.
+
+# Pages freed per incremental_vacuum run (4 MB at the default page size)
+VACUUM_PAGES = 1000
+BACKUP_KEEP = 7
+
+
+def optimize(path):
+    # 0x10002: analyze every table that looks like it needs it, not just the
+    # ones this (fresh) connection has queried
+    conn = db.open_connection(path)
+    try:
+        conn.execute('PRAGMA optimize=0x10002')
+    finally:
+        conn.close()
+
+
+def checkpoint(path):
+    # Copy what the WAL holds into the database file without waiting on
+    # readers or blocking writers. Returns (busy, wal pages, pages copied).
+    conn = db.open_connection(path)
+    try:
+        return conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    finally:
+        conn.close()
+
+
+def incremental_vacuum(path, pages=VACUUM_PAGES):
+    # Return up to ``pages`` free pages to the file system. Only files made
+    # by db.init_file keep the bookkeeping for it. A database created before
+    # that needs a one-off, with the API stopped as it rewrites the file:
+    #   sqlite3 inventory.db 'PRAGMA auto_vacuum=INCREMENTAL' 'VACUUM'
+    # Until then this does nothing. Returns the number of free pages released.
+    conn = db.open_connection(path)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            logging.debug(f"'{path}' does not use incremental auto_vacuum")
+            return 0
+        before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+        return before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def backup(path, directory, keep=BACKUP_KEEP):
+    """Copy the database at ``path`` into ``directory``.
+
+    The copy is a consistent snapshot taken in one read transaction, which
+    under WAL does not block writers. It is written under a temporary name
+    and renamed, so a file named like a backup is always complete. Only the
+    newest ``keep`` backups of each database are kept. Returns the file name.
+    """
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    target = os.path.join(directory, f"{stem}-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}.db")
+    partial = target + '.partial'
+
+    source = db.open_connection(path, read_only=True)
+    try:
+        destination = sqlite3.connect(partial)
+        try:
+            source.backup(destination)
+        finally:
+            destination.close()
+    finally:
+        source.close()
+    os.replace(partial, target)
+
+    # Timestamped names sort oldest first
+    for old in sorted(glob.glob(os.path.join(directory, f'{stem}-*.db')))[:-keep]:
+        os.remove(old)
+    return target
@@ -0,0 +1,262 @@
+import bisect
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Scheduled jobs take from milliseconds to many minutes
+JOB_BUCKETS = (0.01, 0.1, 1.0, 10.0, 60.0, 300.0, 900.0, 3600.0)
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4'
+
+
+def statement_label(sql):
+    # 'SELECT ... FROM items ...' -> 'SELECT items'; keeps label cardinality low
+    # however many distinct parameter lists a statement is run with
+    words = sql.split(None, 1)
+    if not words:
+        return ''
+    verb = words[0].upper()
+    table = re.search(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)', sql, re.IGNORECASE)
+    return f'{verb} {table.group(1)}' if table else verb
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items()) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{format_labels({**labels, "le": bound})} {cumulative}'
+        yield f'{name}_sum{format_labels(labels)} {self.sum}'
+        yield f'{name}_count{format_labels(labels)} {self.count}'
+
+
+class Metrics:
+    """Request and SQL timings kept in memory and rendered for Prometheus.
+
+    SQL statements are timed by the connection class from
+    ``connection_class``, which only replaces sqlite3.Connection while
+    metrics or slow query logging are on. Values are per process, so with
+    several gunicorn workers each scrape reports the worker that answered.
+    """
+
+    def __init__(self):
+        self.slow_query_seconds = None
+        # Reentrant: a dropped cursor reports its statement from __del__,
+        # which garbage collection can run while the lock is held
+        self._lock = threading.RLock()
+        self._requests = {}
+        self._responses = {}
+        self._queries = {}
+        self._slow_queries = {}
+        self._jobs = {}
+        self._job_runs = {}
+
+    def observe_request(self, route, method, status, seconds):
+        with self._lock:
+            histogram = self._requests.get((route, method))
+            if histogram is None:
+                histogram = self._requests[(route, method)] = Histogram()
+            histogram.observe(seconds)
+            key = (route, method, status)
+            self._responses[key] = self._responses.get(key, 0) + 1
+
+    def observe_job(self, name, seconds, ok):
+        # Scheduled jobs are recorded whether or not METRICS is on; they are
+        # rare and only counted in the worker that ran them
+        with self._lock:
+            histogram = self._jobs.get(name)
+            if histogram is None:
+                histogram = self._jobs[name] = Histogram(JOB_BUCKETS)
+            histogram.observe(seconds)
+            key = (name, 'ok' if ok else 'failed')
+            self._job_runs[key] = self._job_runs.get(key, 0) + 1
+
+    def observe_query(self, cursor, sql, parameters, seconds):
+        label = statement_label(sql)
+        slow = self.slow_query_seconds is not None and seconds >= self.slow_query_seconds
+        with self._lock:
+            histogram = self._queries.get(label)
+            if histogram is None:
+                histogram = self._queries[label] = Histogram()
+            histogram.observe(seconds)
+            if slow:
+                self._slow_queries[label] = self._slow_queries.get(label, 0) + 1
+        if slow:
+            self.log_slow_query(cursor, sql, parameters, seconds)
+
+    def log_slow_query(self, cursor, sql, parameters, seconds):
+        # Table scans in the plan are usually the reason, so log them too
+        scans = []
+        if parameters is not None and statement_label(sql).split(' ')[0] in ('SELECT', 'WITH'):
+            try:
+                # A plain cursor, so the EXPLAIN itself is not timed
+                plan = sqlite3.Cursor(cursor.connection).execute(
+                    f'EXPLAIN QUERY PLAN {sql}', parameters)
+                scans = [row[3] for row in plan if row[3].startswith('SCAN')]
+            except sqlite3.Error:
+                pass
+        message = f"Slow query ({seconds * 1000:.1f} ms): {' '.join(sql.split())}"
+        if scans:
+            message += f" [{'; '.join(scans)}]"
+        logging.warning(message)
+
+    def connection_class(self):
+        registry = self
+
+        class TimedCursor(sqlite3.Cursor):
+            # A statement's time covers execute() and every fetch until the
+            # result is exhausted, the cursor is reused, closed or dropped
+            _statement = None
+            _elapsed = 0.0
+
+            def _timed(self, method, *args):
+                start = time.perf_counter()
+                try:
+                    return method(*args)
+                finally:
+                    self._elapsed += time.perf_counter() - start
+
+            def _finish(self):
+                if self._statement is not None:
+                    sql, parameters = self._statement
+                    self._statement = None
+                    registry.observe_query(self, sql, parameters, self._elapsed)
+
+            def execute(self, sql, parameters=()):
+                self._finish()
+                self._statement = (sql, parameters)
+                self._elapsed = 0.0
+                return self._timed(super().execute, sql, parameters)
+
+            def executemany(self, sql, seq_of_parameters):
+                self._finish()
+                self._statement = (sql, None)
+                self._elapsed = 0.0
+                return self._timed(super().executemany, sql, seq_of_parameters)
+
+            def fetchone(self):
+                row = self._timed(super().fetchone)
+                if row is None:
+                    self._finish()
+                return row
+
+            def fetchmany(self, size=None):
+                size = self.arraysize if size is None else size
+                rows = self._timed(super().fetchmany, size)
+                if len(rows) < size:
+                    self._finish()
+                return rows
+
+            def fetchall(self):
+                rows = self._timed(super().fetchall)
+                self._finish()
+                return rows
+
+            def __next__(self):
+                try:
+                    return self._timed(super().__next__)
+                except StopIteration:
+                    self._finish()
+                    raise
+
+            def close(self):
+                self._finish()
+                super().close()
+
+            def __del__(self):
+                self._finish()
+
+        class TimedConnection(sqlite3.Connection):
+            def cursor(self, factory=TimedCursor):
+                return super().cursor(factory)
+
+            # sqlite3.Connection.execute does not go through cursor()
+            def execute(self, sql, parameters=()):
+                return self.cursor().execute(sql, parameters)
+
+            def executemany(self, sql, seq_of_parameters):
+                return self.cursor().executemany(sql, seq_of_parameters)
+
+        return TimedConnection
+
+    def render(self, gauges=()):
+        # ``gauges`` are (name, type, help, [(labels, value), ...]) collected
+        # from the caches, pools and other components at scrape time
+        with self._lock:
+            requests = {key: histogram.copy() for key, histogram in self._requests.items()}
+            responses = dict(self._responses)
+            queries = {key: histogram.copy() for key, histogram in self._queries.items()}
+            slow_queries = dict(self._slow_queries)
+            jobs = {key: histogram.copy() for key, histogram in self._jobs.items()}
+            job_runs = dict(self._job_runs)
+
+        errors = {key: 0 for key in requests}
+        for (route, method, status), count in responses.items():
+            if status >= 500:
+                errors[(route, method)] = errors.get((route, method), 0) + count
+
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+
+        family('svp_http_requests_total', 'counter', 'HTTP responses by route, method and status.',
+               [f'svp_http_requests_total{format_labels({"route": route, "method": method, "status": status})} {count}'
+                for (route, method, status), count in sorted(responses.items())])
+        family('svp_http_request_errors_total', 'counter', 'HTTP responses with a 5xx status.',
+               [f'svp_http_request_errors_total{format_labels({"route": route, "method": method})} {count}'
+                for (route, method), count in sorted(errors.items())])
+        family('svp_http_request_duration_seconds', 'histogram', 'Time spent in the view, by route.',
+               [sample for (route, method), histogram in sorted(requests.items())
+                for sample in histogram.samples('svp_http_request_duration_seconds',
+                                                {'route': route, 'method': method})])
+        family('svp_sql_query_duration_seconds', 'histogram', 'SQLite statement time, by statement and table.',
+               [sample for label, histogram in sorted(queries.items())
+                for sample in histogram.samples('svp_sql_query_duration_seconds', {'statement': label})])
+        family('svp_sql_slow_queries_total', 'counter', 'Statements slower than the slow query threshold.',
+               [f'svp_sql_slow_queries_total{format_labels({"statement": label})} {count}'
+                for label, count in sorted(slow_queries.items())])
+        family('svp_job_runs_total', 'counter', 'Scheduled job runs by job and status.',
+               [f'svp_job_runs_total{format_labels({"job": name, "status": status})} {count}'
+                for (name, status), count in sorted(job_runs.items())])
+        family('svp_job_duration_seconds', 'histogram', 'Time taken by scheduled jobs, by job.',
+               [sample for name, histogram in sorted(jobs.items())
+                for sample in histogram.samples('svp_job_duration_seconds', {'job': name})])
+        for name, kind, help, samples in gauges:
+            family(name, kind, help,
+                   [f'{name}{format_labels(labels)} {value}' for labels, value in samples])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,190 @@
+import argparse
+import logging
+import sys
+
+import customers
+import db
+import expiry
+import ledger
+import login_keys
+import reports
+import scheduler
+import search
+
+# Versioned schema changes applied on top of create_database_and_tables().
+# Each migration is (version, name, steps); a step is either an SQL string or
+# a callable taking the cursor. Versions must only ever be appended.
+
+INVENTORY_MIGRATIONS = [
+    (1, 'index items and sales by day', [
+        'CREATE INDEX IF NOT EXISTS idx_items_added_day ON items(date(added_date))',
+        'CREATE INDEX IF NOT EXISTS idx_sales_sale_day ON sales(date(sale_date))',
+    ]),
+    (2, 'index sales by product', [
+        'CREATE INDEX IF NOT EXISTS idx_sales_product_id ON sales(product_id)',
+    ]),
+    (3, 'daily report rollup', reports.CREATE_ROLLUP + [reports.rebuild_rollup]),
+    (4, 'dealer on sold rollup rows', reports.SOLD_DEALER_TRIGGER),
+    (5, 'one customer per phone number',
+     customers.ADD_PHONE_KEY + [customers.merge_duplicates] + customers.UNIQUE_PHONE_KEY),
+    (6, 'normalized item expiry date',
+     expiry.ADD_EXPIRY_DAY + [expiry.fill_expiry_day] + expiry.INDEX_EXPIRY_DAY),
+    (7, 'stock ledger', ledger.CREATE_LEDGER + [ledger.fill_ledger] + ledger.INDEX_LEDGER),
+    (8, 'full-text search', search.CREATE_SEARCH),
+    (9, 'scheduler job locks', scheduler.CREATE_JOBS),
+    (10, 'search dealers by normalized phone',
+     search.ADD_DEALER_PHONE_KEY + [search.fill_dealer_phone_key] + search.REINDEX_DEALERS),
+    (11, 'customer renames in the rollup', reports.CUSTOMER_NAME_TRIGGER),
+    (12, 'read expiry dates sent as date-times', [expiry.fill_missing_expiry_day]),
+]
+
+NOTIFICATION_MIGRATIONS = [
+    (1, 'index login_key by key', [
+        'CREATE INDEX IF NOT EXISTS idx_login_key_key ON login_key(key)',
+    ]),
+    (2, 'index notifications by key and status', [
+        'CREATE INDEX IF NOT EXISTS idx_notifications_key_status ON notifications(key, status)',
+    ]),
+    (3, 'scheduled notifications', [
+        '''
+        CREATE TABLE IF NOT EXISTS scheduled_notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            body TEXT,
+            keys TEXT,
+            deliver_at TIMESTAMP NOT NULL,
+            delivered INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_scheduled_notifications_due ON scheduled_notifications(delivered, deliver_at)',
+    ]),
+    (4, 'index notifications by key and id', [
+        'CREATE INDEX IF NOT EXISTS idx_notifications_key_id ON notifications(key, id)',
+    ]),
+    (5, 'login key expiry', login_keys.ADD_EXPIRY),
+]
+
+MIGRATIONS = {
+    db.INVENTORY_DB: INVENTORY_MIGRATIONS,
+    db.NOTIFICATION_DB: NOTIFICATION_MIGRATIONS,
+}
+
+# Hot queries that must be answered without a full table scan
+HOT_QUERIES = {
+    db.INVENTORY_DB: [
+        ('check_quantity',
+         'SELECT quantity FROM items WHERE id = ? AND batch_no = ?', (1, 'B1')),
+        ('customer by phone', 'SELECT id FROM customers WHERE phone_key = ?', ('9800000000',)),
+        ('expiring', expiry.expiring_query(), ('2024-01-01',)),
+        ('fefo batches', expiry.BATCHES_QUERY, (1, '2024-01-01')),
+        ('stock at', 'SELECT sum(quantity) FROM stock_ledger WHERE product_id = ? AND created >= ? AND created < ?',
+         (1, '2024-01-01', '2024-01-02')),
+        ('daily_report added', reports.ADDED_QUERY + ' AND dealer_name = ?', ('2024-01-01', 'dealer')),
+        ('daily_report sold', reports.SOLD_QUERY + ' AND customer_name = ?', ('2024-01-01', 'customer')),
+        ('customer rename', "UPDATE daily_rollup SET customer_name = ? WHERE kind = 'sold' AND customer_id = ?",
+         ('customer', 1)),
+        ('report', reports.grouped_query('month', reports.range_filter('2024-01-01', '2024-12-31')[0]),
+         ('2024-01-01', '2024-12-31')),
+    ],
+    db.NOTIFICATION_DB: [
+        ('verify_key', login_keys.SECONDS_LEFT_QUERY, ('KEY',)),
+        ('expired keys', 'SELECT key FROM login_key WHERE expires_at <= CURRENT_TIMESTAMP LIMIT ?', (500,)),
+        ('notice', 'SELECT id, body, title FROM notifications WHERE key=? AND status=?', ('KEY', 0)),
+        ('notices', 'SELECT body, title FROM notifications WHERE key=?', ('KEY',)),
+        ('notifications_sync',
+         'SELECT id, title FROM notifications WHERE key = ? AND id > ? ORDER BY id LIMIT ?', ('KEY', 0, 10)),
+    ],
+}
+
+
+def applied_versions(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('SELECT version FROM schema_migrations')
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(path, migrations=None):
+    if migrations is None:
+        migrations = MIGRATIONS[path]
+    conn = db.open_connection(path)
+    try:
+        cursor = conn.cursor()
+        done = applied_versions(cursor)
+        conn.commit()
+        applied = []
+        for version, name, steps in migrations:
+            if version in done:
+                continue
+            # Each migration runs in its own write transaction
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.execute(
+                    'SELECT 1 FROM schema_migrations WHERE version = ?', (version,))
+                if cursor.fetchone() is None:
+                    for step in steps:
+                        if callable(step):
+                            step(cursor)
+                        else:
+                            cursor.execute(step)
+                    cursor.execute(
+                        'INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (version, name))
+                    applied.append(version)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logging.info(f"Applied migration {version} ({name}) to '{path}'")
+        return applied
+    finally:
+        conn.close()
+
+
+def migrate_all():
+    for path in MIGRATIONS:
+        migrate(path)
+
+
+def full_scans(path):
+    # Returns (name, plan detail) for every hot query that scans a table
+    conn = db.open_connection(path)
+    try:
+        scans = []
+        for name, query, params in HOT_QUERIES[path]:
+            for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params):
+                detail = row[3]
+                if detail.startswith('SCAN') and 'COVERING INDEX' not in detail:
+                    scans.append((name, detail))
+        return scans
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply schema migrations')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if a hot query plan contains a full table scan')
+    args = parser.parse_args()
+
+    # Create the base tables and apply pending migrations first
+    import auth
+    auth.create_database_and_tables()
+
+    if args.check:
+        failed = False
+        for path in HOT_QUERIES:
+            for name, detail in full_scans(path):
+                print(f'{path}: {name}: {detail}')
+                failed = True
+        if failed:
+            sys.exit(1)
+        print('No full table scans on hot queries.')
+
+
+if __name__ == '__main__':
+    main()
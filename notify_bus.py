@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+import db
+
+# How often the watcher checks login_notification_data.db for new rows while
+# at least one client is subscribed
+POLL_INTERVAL = 1.0
+
+
+class Subscription:
+    def __init__(self, key):
+        self.key = key
+        self.events = queue.SimpleQueue()
+
+    def push(self, row):
+        # Called from the watcher thread
+        self.events.put(row)
+
+    def get(self, timeout):
+        # Returns a list of (id, title, body) rows, empty on timeout
+        try:
+            rows = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                rows.append(self.events.get_nowait())
+            except queue.Empty:
+                return rows
+
+
+class AsyncSubscription(Subscription):
+    """Subscription awaited on an asyncio event loop instead of a thread.
+
+    Must be created on the loop that awaits it; rows pushed by the watcher
+    thread are handed over with ``call_soon_threadsafe``.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+
+    def push(self, row):
+        try:
+            self.loop.call_soon_threadsafe(self.events.put_nowait, row)
+        except RuntimeError:  # the loop has been closed
+            pass
+
+    async def get(self, timeout):
+        try:
+            rows = [await asyncio.wait_for(self.events.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while not self.events.empty():
+            rows.append(self.events.get_nowait())
+        return rows
+
+
+class NotificationBus:
+    """Fans new notification rows out to subscribers waiting on their key.
+
+    A single watcher thread checks ``PRAGMA data_version`` and reads rows
+    newer than the last one it has seen, so the database work is the same
+    for one idle client or thousands. Notifications are inserted by other
+    processes (add_notify.py), which is why this watches the database
+    instead of relying on in-process publishing alone.
+    """
+
+    def __init__(self, path=db.NOTIFICATION_DB, poll_interval=POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread_pid = None
+        self._conn = None
+        self._data_version = None
+        self._last_id = None
+        self.polls = 0
+        self.queries = 0
+
+    def subscribe(self, key, subscription_class=Subscription):
+        subscription = subscription_class(key)
+        with self._lock:
+            self._subscribers.setdefault(key, set()).add(subscription)
+        self._ensure_started()
+        self._wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.key)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.key]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def wake(self):
+        # Called after an in-process insert (the scheduler's notification
+        # jobs) so subscribers hear about it now rather than at the next poll
+        self._wakeup.set()
+
+    def poll_once(self):
+        self.polls += 1
+        data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return 0
+        self._data_version = data_version
+        self.queries += 1
+        rows = self._conn.execute('''
+            SELECT id, key, title, body FROM notifications
+            WHERE id > ? AND status = 0
+            ORDER BY id
+        ''', (self._last_id,)).fetchall()
+        if not rows:
+            return 0
+        self._last_id = rows[-1][0]
+        with self._lock:
+            for id, key, title, body in rows:
+                for subscription in self._subscribers.get(key, ()):
+                    subscription.push((id, title, body))
+        return len(rows)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            if not self.subscriber_count():
+                continue
+            try:
+                self.poll_once()
+            except sqlite3.Error as e:
+                logging.error(f"SQLite error in notification watcher: {e}")
+
+    def _ensure_started(self):
+        # Started on first subscribe, and again in each forked worker
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            # Rows up to here are returned by the route's own unread query;
+            # the watcher only delivers rows inserted after this point
+            self._conn = db.open_connection(self.path)
+            self._data_version = None
+            self._last_id = self._conn.execute(
+                'SELECT coalesce(max(id), 0) FROM notifications').fetchone()[0]
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='notification-bus', daemon=True).start()
@@ -1,3 +1,4 @@
+import os
 import re
 import subprocess
 import sys
@@ -5,13 +6,21 @@ import json
 from colorama import Fore, Style
 
 
+def write_atomic(path, content):
+    # The API server reloads these files while running; replace them in one
+    # step so it never reads a half-written file
+    temp_path = f'.{path}.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(content)
+    os.replace(temp_path, path)
+
+
 def new_release(version_number):
     release_command = f'gh release create v{
         version_number} svp\\build\\app\\outputs\\flutter-apk\\app-release.apk --generate-notes'
     result = subprocess.run(release_command, shell=True,
                             capture_output=True, text=True)
-    with open('url', 'w') as file_url:
-        file_url.write(result.stdout)
+    return result.stdout.strip()
 
 
 def exit_program():
@@ -52,18 +61,16 @@ if release_info.returncode == 0:
         print(Fore.GREEN + 'Already released')
         print(existing_url)
         print(Style.RESET_ALL)
-        # Write the existing URL to a file
-        with open('url', 'w') as file_url:
-            file_url.write(existing_url)
     else:
         existing_url = None
 else:
-    new_release(version_number)
+    existing_url = new_release(version_number)
 
 
-# Write the version number to a file
-with open('version', 'w') as version_file:
-    version_file.write(version_number)
+# Version and URL go into one file, replaced in one step, so the API server
+# never pairs a new URL with the old version
+if existing_url:
+    write_atomic('release', json.dumps({'version': version_number, 'url': existing_url}))
 
 # Optional: Print the result output for debugging
 print("Version number written to file:", version_number)
@@ -0,0 +1,229 @@
+import argparse
+import logging
+import time
+
+import db
+
+# daily_rollup holds one row per day x item batch (added stock) and per
+# day x item batch x customer (sales). Triggers on items and sales keep it
+# up to date inside the writing transaction, so /daily-report never has to
+# scan the base tables.
+
+CREATE_ROLLUP = [
+    '''
+    CREATE TABLE IF NOT EXISTS daily_rollup (
+        day TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        customer_id INTEGER NOT NULL DEFAULT 0,
+        item TEXT,
+        batch_no TEXT,
+        manufacture_date TEXT,
+        dealer_name TEXT,
+        customer_name TEXT,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        total_price REAL,
+        PRIMARY KEY (day, kind, product_id, customer_id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_items_daily_rollup AFTER INSERT ON items
+    BEGIN
+        INSERT INTO daily_rollup (day, kind, product_id, customer_id, item, batch_no,
+                                  manufacture_date, dealer_name, quantity)
+        SELECT date(NEW.added_date), 'added', NEW.id, 0, NEW.item, NEW.batch_no,
+               NEW.manufacture_date, NEW.dealer_name, NEW.quantity
+        WHERE true
+        ON CONFLICT (day, kind, product_id, customer_id)
+        DO UPDATE SET quantity = quantity + excluded.quantity;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_sales_daily_rollup AFTER INSERT ON sales
+    BEGIN
+        INSERT INTO daily_rollup (day, kind, product_id, customer_id, item, batch_no,
+                                  manufacture_date, customer_name, quantity, total_price)
+        SELECT date(NEW.sale_date), 'sold', NEW.product_id, coalesce(NEW.customer_id, 0),
+               i.item, i.batch_no, i.manufacture_date, c.name, NEW.quantity, NEW.total_price
+        FROM items i
+        LEFT JOIN customers c ON c.id = NEW.customer_id
+        WHERE i.id = NEW.product_id
+        ON CONFLICT (day, kind, product_id, customer_id)
+        DO UPDATE SET quantity = quantity + excluded.quantity,
+                      total_price = total_price + excluded.total_price;
+    END
+    ''',
+]
+
+# Sold rows also carry the dealer of the batch so range reports can group
+# sales by dealer
+SOLD_DEALER_TRIGGER = [
+    'DROP TRIGGER IF EXISTS trg_sales_daily_rollup',
+    '''
+    CREATE TRIGGER trg_sales_daily_rollup AFTER INSERT ON sales
+    BEGIN
+        INSERT INTO daily_rollup (day, kind, product_id, customer_id, item, batch_no,
+                                  manufacture_date, dealer_name, customer_name, quantity, total_price)
+        SELECT date(NEW.sale_date), 'sold', NEW.product_id, coalesce(NEW.customer_id, 0),
+               i.item, i.batch_no, i.manufacture_date, i.dealer_name, c.name,
+               NEW.quantity, NEW.total_price
+        FROM items i
+        LEFT JOIN customers c ON c.id = NEW.customer_id
+        WHERE i.id = NEW.product_id
+        ON CONFLICT (day, kind, product_id, customer_id)
+        DO UPDATE SET quantity = quantity + excluded.quantity,
+                      total_price = total_price + excluded.total_price;
+    END
+    ''',
+    '''
+    UPDATE daily_rollup
+    SET dealer_name = (SELECT i.dealer_name FROM items i WHERE i.id = daily_rollup.product_id)
+    WHERE kind = 'sold'
+    ''',
+]
+
+# customers.upsert gives a repeat buyer the latest name, so sold rows follow
+# renames instead of keeping the name used at the time of each sale
+CUSTOMER_NAME_TRIGGER = [
+    "CREATE INDEX IF NOT EXISTS idx_daily_rollup_customer ON daily_rollup(customer_id) WHERE kind = 'sold'",
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_customers_daily_rollup AFTER UPDATE OF name ON customers
+    WHEN OLD.name IS NOT NEW.name
+    BEGIN
+        UPDATE daily_rollup SET customer_name = NEW.name
+        WHERE kind = 'sold' AND customer_id = NEW.id;
+    END
+    ''',
+    '''
+    UPDATE daily_rollup
+    SET customer_name = (SELECT c.name FROM customers c WHERE c.id = daily_rollup.customer_id)
+    WHERE kind = 'sold' AND customer_id != 0
+    ''',
+]
+
+ADDED_QUERY = '''
+    SELECT 'Added' AS type, item, quantity, batch_no, manufacture_date AS date, dealer_name, day AS added_date, NULL AS customer_name, NULL AS total_price
+    FROM daily_rollup
+    WHERE kind = 'added' AND day = ?
+'''
+
+SOLD_QUERY = '''
+    SELECT 'Sold' AS type, item, quantity, batch_no, manufacture_date AS date, NULL AS dealer_name, day AS added_date, customer_name, total_price
+    FROM daily_rollup
+    WHERE kind = 'sold' AND day = ?
+'''
+
+
+# SQL expression for each /report grouping; weeks start on Monday
+GROUP_BY = {
+    'day': 'day',
+    'week': "date(day, '-6 days', 'weekday 1')",
+    'month': 'substr(day, 1, 7)',
+    'item': 'item',
+    'dealer': 'dealer_name',
+    'customer': 'customer_name',
+}
+
+TOTALS = '''
+    sum(CASE WHEN kind = 'added' THEN quantity ELSE 0 END),
+    sum(CASE WHEN kind = 'sold' THEN quantity ELSE 0 END),
+    coalesce(sum(CASE WHEN kind = 'sold' THEN total_price END), 0)
+'''
+
+
+def range_filter(start_date, end_date, dealer_name=None, customer_name=None):
+    # WHERE clause and params shared by the totals and grouped range queries
+    where = 'day BETWEEN ? AND ?'
+    params = [start_date, end_date]
+    if dealer_name:
+        where += ' AND dealer_name = ?'
+        params.append(dealer_name)
+    if customer_name:
+        where += ' AND customer_name = ?'
+        params.append(customer_name)
+    return where, params
+
+
+def totals_query(where):
+    return f'SELECT {TOTALS} FROM daily_rollup WHERE {where}'
+
+
+def grouped_query(group_by, where):
+    return f'''
+        SELECT {GROUP_BY[group_by]} AS grp, {TOTALS}
+        FROM daily_rollup
+        WHERE {where}
+        GROUP BY grp
+        ORDER BY grp
+    '''
+
+
+def rebuild_rollup(cursor):
+    # Recompute daily_rollup from the full items and sales history. Once
+    # migrations have added the stock ledger, the received quantity is the
+    # batch's receipt entry, which stays right when sales are cleared or
+    # stock adjusted. Before that, sales have decremented items.quantity,
+    # so it is what is left plus what has been sold since.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stock_ledger'")
+    if cursor.fetchone():
+        received = '''coalesce((SELECT sum(l.quantity) FROM stock_ledger l
+                                   WHERE l.product_id = i.id AND l.kind = 'receipt'), 0)'''
+    else:
+        received = '''i.quantity + coalesce((SELECT sum(s.quantity) FROM sales s
+                                              WHERE s.product_id = i.id), 0)'''
+    cursor.execute('DELETE FROM daily_rollup')
+    cursor.execute(f'''
+        INSERT INTO daily_rollup (day, kind, product_id, customer_id, item, batch_no,
+                                  manufacture_date, dealer_name, quantity)
+        SELECT date(i.added_date), 'added', i.id, 0, i.item, i.batch_no,
+               i.manufacture_date, i.dealer_name, {received}
+        FROM items i
+        WHERE i.added_date IS NOT NULL
+    ''')
+    cursor.execute('''
+        INSERT INTO daily_rollup (day, kind, product_id, customer_id, item, batch_no,
+                                  manufacture_date, dealer_name, customer_name, quantity, total_price)
+        SELECT date(s.sale_date), 'sold', s.product_id, coalesce(s.customer_id, 0),
+               i.item, i.batch_no, i.manufacture_date, i.dealer_name, c.name,
+               sum(s.quantity), sum(s.total_price)
+        FROM sales s
+        JOIN items i ON s.product_id = i.id
+        LEFT JOIN customers c ON s.customer_id = c.id
+        WHERE s.sale_date IS NOT NULL
+        GROUP BY date(s.sale_date), s.product_id, coalesce(s.customer_id, 0)
+    ''')
+
+
+def clear_rollup(cursor, items=False, sales=False, customers=False):
+    # Mirror /clear-data: reports join sales to items and left join customers
+    if items:
+        cursor.execute('DELETE FROM daily_rollup')
+    elif sales:
+        cursor.execute("DELETE FROM daily_rollup WHERE kind = 'sold'")
+    if customers:
+        cursor.execute(
+            "UPDATE daily_rollup SET customer_name = NULL WHERE kind = 'sold'")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report maintenance')
+    parser.add_argument('command', choices=['rebuild'])
+    parser.parse_args()
+
+    # Create the base tables and apply pending migrations first
+    import auth
+    auth.create_database_and_tables()
+
+    start = time.perf_counter()
+    with db.inventory() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        rebuild_rollup(cursor)
+        cursor.execute('SELECT count(*) FROM daily_rollup')
+        rows = cursor.fetchone()[0]
+    logging.info(f'Rebuilt daily_rollup with {rows} rows in {time.perf_counter() - start:.2f}s')
+    print(f'daily_rollup rebuilt: {rows} rows')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+import argparse
+import logging
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from datetime import timedelta
+
+import db
+import expiry
+import ledger
+import login_keys
+import maintenance
+import reports
+
+# Maintenance jobs run off the request path by a daemon thread in each API
+# process when SVP_SCHEDULER=1, or by `scheduler.py serve`. Every job runs
+# at fixed slots: an interval of 1h means on the hour (UTC), 1d at midnight,
+# so all workers agree on when a job is due. A row in scheduler_jobs is the
+# lock: the first worker to claim a due slot runs it and moves next_run on,
+# the others find it taken. A claim is a lease that expires after the job's
+# timeout, so a worker that dies mid-job does not hold it forever.
+
+CREATE_JOBS = [
+    '''
+    CREATE TABLE IF NOT EXISTS scheduler_jobs (
+        name TEXT PRIMARY KEY,
+        next_run REAL NOT NULL,
+        locked_by TEXT,
+        locked_until REAL,
+        last_started REAL,
+        last_seconds REAL,
+        last_status TEXT,
+        last_error TEXT,
+        runs INTEGER NOT NULL DEFAULT 0,
+        failures INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+]
+
+# '30s', '15m', '6h', '1d' or one of the aliases
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+ALIASES = {'@hourly': '1h', '@daily': '1d', '@weekly': '7d'}
+
+DEFAULT_TIMEOUT = 3600
+# Longest the thread sleeps between looking for due jobs
+MAX_SLEEP = 60
+
+
+def parse_interval(spec):
+    # Returns seconds
+    spec = ALIASES.get(str(spec).strip(), str(spec).strip())
+    match = re.fullmatch(r'(\d+)\s*([smhd])', spec)
+    if match is None or not int(match.group(1)):
+        raise ValueError(f'Invalid interval: {spec!r}')
+    return int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+
+
+def next_slot(interval, now):
+    # Start of the next slot after ``now``, in epoch seconds
+    return (int(now) // interval + 1) * interval
+
+
+class Job:
+    def __init__(self, name, every, func, timeout=DEFAULT_TIMEOUT, description=''):
+        self.name = name
+        self.every = every
+        self.interval = parse_interval(every)
+        self.func = func
+        self.timeout = timeout
+        self.description = description
+
+
+def default_jobs(config=None, on_keys=None, on_notify=None):
+    # The jobs an API process runs; ``config`` is the Flask config or
+    # DEFAULT_CONFIG, ``on_keys`` is told about pruned login keys and
+    # ``on_notify`` is called after notifications have been inserted.
+    # Backups and the expiry alert only run when configured.
+    config = config or {}
+    backup_dir = config.get('BACKUP_DIR', '')
+    backup_keep = int(config.get('BACKUP_KEEP', maintenance.BACKUP_KEEP))
+    read_days = int(config.get('READ_RETENTION_DAYS', login_keys.READ_RETENTION_DAYS))
+    alert_days = int(config.get('EXPIRY_ALERT_DAYS', 0))
+
+    def each_database(func):
+        return lambda: [func(path) for path in (db.INVENTORY_DB, db.NOTIFICATION_DB)]
+
+    def prune_keys():
+        return login_keys.prune(on_keys=on_keys)
+
+    def snapshot_yesterday():
+        day = (ledger.utc_today() - timedelta(days=1)).isoformat()
+        return db.write(db.INVENTORY_DB, lambda cursor: ledger.snapshot(cursor, day))
+
+    def notified(sent):
+        if sent and on_notify:
+            on_notify()
+        return sent
+
+    def deliver_notifications():
+        import add_notify
+        batches, sent = add_notify.deliver_due()
+        return notified(sent)
+
+    def expiry_alert():
+        return notified(expiry.alert(alert_days))
+
+    jobs = [
+        Job('deliver_notifications', '1m', deliver_notifications,
+            description='send scheduled notifications that are due'),
+        Job('checkpoint', '15m', each_database(maintenance.checkpoint),
+            description='copy the WAL into the database files'),
+        Job('prune_keys', '1h', prune_keys,
+            description='delete expired login keys and their notifications'),
+        Job('prune_read_notifications', '1d', lambda: login_keys.prune_read(read_days),
+            description=f'delete read notifications older than {read_days} days'),
+        Job('optimize', '1d', each_database(maintenance.optimize),
+            description='refresh query planner statistics'),
+        Job('incremental_vacuum', '1d', each_database(maintenance.incremental_vacuum),
+            description='return free pages to the file system'),
+        Job('ledger_snapshot', '1d', snapshot_yesterday,
+            description="checkpoint yesterday's stock balances"),
+        Job('rebuild_rollup', '1d', lambda: db.write(db.INVENTORY_DB, reports.rebuild_rollup),
+            description='recompute the daily report rollup from the full history'),
+    ]
+    if backup_dir:
+        jobs.append(Job('backup', '1d',
+                        each_database(lambda path: maintenance.backup(path, backup_dir, backup_keep)),
+                        description=f'copy both databases into {backup_dir}/'))
+    if alert_days:
+        jobs.append(Job('expiry_alert', '1d', expiry_alert,
+                        description=f'notify users of stock expiring within {alert_days} days'))
+    return jobs
+
+
+def register(cursor, jobs, now):
+    # A job seen for the first time is due at its next slot, not at once
+    cursor.executemany('INSERT OR IGNORE INTO scheduler_jobs (name, next_run) VALUES (?, ?)',
+                       [(job.name, next_slot(job.interval, now)) for job in jobs])
+
+
+def claim(cursor, job, owner, now, force=False):
+    # True when ``owner`` got the lease; ``force`` claims a job that is not
+    # due yet but still never one another worker is running
+    cursor.execute('INSERT OR IGNORE INTO scheduler_jobs (name, next_run) VALUES (?, ?)',
+                   (job.name, next_slot(job.interval, now)))
+    cursor.execute('''
+        UPDATE scheduler_jobs
+        SET locked_by = ?, locked_until = ?, last_started = ?
+        WHERE name = ? AND coalesce(locked_until, 0) <= ? AND (? OR next_run <= ?)
+    ''', (owner, now + job.timeout, now, job.name, now, force, now))
+    return cursor.rowcount == 1
+
+
+def release(cursor, job, owner, finished, seconds, error=None):
+    cursor.execute('''
+        UPDATE scheduler_jobs
+        SET locked_by = NULL, locked_until = NULL, next_run = ?, last_seconds = ?,
+            last_status = ?, last_error = ?, runs = runs + 1, failures = failures + ?
+        WHERE name = ? AND locked_by = ?
+    ''', (next_slot(job.interval, finished), seconds, 'failed' if error else 'ok', error,
+          1 if error else 0, job.name, owner))
+
+
+class Scheduler:
+    """Runs due jobs one at a time in a daemon thread.
+
+    ``on_finish(name, seconds, ok)`` is called after every run, e.g. to
+    record its time for /metrics. Jobs are claimed separately, so while one
+    worker is busy with a long job another can run the next one that is due.
+    """
+
+    def __init__(self, jobs, on_finish=None):
+        self.jobs = {job.name: job for job in jobs}
+        self.on_finish = on_finish
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._due = {}
+
+    def run(self, name, force=False):
+        # Returns 'ok' or 'failed', or None when the job was not due or
+        # another worker holds it
+        job = self.jobs[name]
+        if not db.write(db.INVENTORY_DB, lambda cursor: claim(cursor, job, self.owner, time.time(), force)):
+            return None
+        start = time.perf_counter()
+        error = None
+        try:
+            job.func()
+        except Exception as e:
+            logging.exception(f"Scheduled job '{name}' failed")
+            error = f'{type(e).__name__}: {e}'
+        seconds = time.perf_counter() - start
+        db.write(db.INVENTORY_DB, lambda cursor: release(cursor, job, self.owner, time.time(), seconds, error))
+        if self.on_finish:
+            self.on_finish(name, seconds, error is None)
+        logging.info(f"Scheduled job '{name}' {'failed' if error else 'finished'} in {seconds:.2f}s")
+        return 'failed' if error else 'ok'
+
+    def run_pending(self):
+        # Try every job whose slot has come. Slots are tracked locally, so
+        # the database is only asked once per slot per worker.
+        now = time.time()
+        for name, job in self.jobs.items():
+            if self._due.setdefault(name, next_slot(job.interval, now)) <= now:
+                self.run(name)
+                self._due[name] = next_slot(job.interval, time.time())
+        return min(self._due.values(), default=now + MAX_SLEEP)
+
+    def start(self):
+        db.write(db.INVENTORY_DB, lambda cursor: register(cursor, self.jobs.values(), time.time()))
+        threading.Thread(target=self._loop, name='scheduler', daemon=True).start()
+
+    def _loop(self):
+        while True:
+            try:
+                due = self.run_pending()
+            except Exception:
+                logging.exception('Scheduler failed')
+                due = time.time() + MAX_SLEEP
+            time.sleep(min(max(due - time.time(), 0.1), MAX_SLEEP))
+
+
+def format_time(epoch):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch)) if epoch else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run maintenance jobs')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='show every job, when it runs next and how its last run went')
+    run_parser = subparsers.add_parser('run', help='run jobs now, even if they are not due')
+    run_parser.add_argument('jobs', nargs='+', metavar='JOB')
+    subparsers.add_parser('serve', help='run jobs as they fall due until interrupted '
+                                        '(instead of SVP_SCHEDULER=1 in the API workers)')
+    args = parser.parse_args()
+
+    # Create the base tables and apply pending migrations first
+    import auth
+    auth.create_database_and_tables()
+    config = {**auth.DEFAULT_CONFIG, **auth.config_from_env()}
+    # Keys pruned here must also drop out of the API workers' key caches
+    if config['CACHE_VERSIONS_FILE']:
+        auth.response_cache.share_versions(config['CACHE_VERSIONS_FILE'])
+    scheduler = Scheduler(default_jobs(config, on_keys=auth.revoke_keys))
+
+    if args.command == 'list':
+        db.write(db.INVENTORY_DB, lambda cursor: register(cursor, scheduler.jobs.values(), time.time()))
+        with db.inventory() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT name, next_run, last_started, last_seconds, last_status, locked_by '
+                           'FROM scheduler_jobs')
+            rows = {row[0]: row[1:] for row in cursor.fetchall()}
+        print('job\tevery\tnext run (UTC)\tlast run (UTC)\tseconds\tstatus')
+        for name, job in scheduler.jobs.items():
+            next_run, last_started, last_seconds, status, locked_by = rows[name]
+            status = f'running on {locked_by}' if locked_by else status or '-'
+            seconds = '-' if last_seconds is None else f'{last_seconds:.2f}'
+            print(f'{name}\t{job.every}\t{format_time(next_run)}\t{format_time(last_started)}\t{seconds}\t{status}')
+
+    elif args.command == 'run':
+        unknown = [name for name in args.jobs if name not in scheduler.jobs]
+        if unknown:
+            sys.exit(f"Unknown job(s): {', '.join(unknown)}. Choose from: {', '.join(scheduler.jobs)}")
+        failed = False
+        for name in args.jobs:
+            status = scheduler.run(name, force=True)
+            print(f"{name}: {status or 'already running elsewhere'}")
+            failed = failed or status != 'ok'
+        if failed:
+            sys.exit(1)
+
+    else:
+        scheduler.start()
+        try:
+            while True:
+                time.sleep(MAX_SLEEP)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
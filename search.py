@@ -0,0 +1,143 @@
+import re
+
+import customers
+
+# Full-text search over item batches, dealers and customers. Each has a
+# contentless FTS5 table keyed by the row id, kept in sync by triggers in
+# the writing transaction. Phone numbers are indexed as their phone_key,
+# normalized by customers.normalize_phone like the query, so '98000' finds
+# '980-0000001'.
+#
+# Prefix indexes for 1 to 6 characters let a type-ahead query read only
+# the first matches of a common word instead of merging every term that
+# starts with it, at about twice the index size.
+#
+# Results are ranked in SQL rather than with bm25(), which reads every row
+# containing each word to weigh it (100+ ms for a word in every item name).
+# The newest CANDIDATES matches are ranked: names equal to the query first,
+# then names starting with it, then shorter names. A query with fewer
+# matches is ranked exactly; a broader one improves as more is typed.
+
+PREFIX_LENGTHS = '1 2 3 4 5 6'
+CANDIDATES = 1000
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+# How migration 8 first indexed dealer phone numbers, in SQL. It only
+# stripped common punctuation, so migration 10 moved dealers to a phone_key
+# column filled by customers.normalize_phone.
+DIGITS = ("replace(replace(replace(replace(replace(replace({0}.phone_no, ' ', ''), "
+          "'-', ''), '+', ''), '(', ''), ')', ''), '.', '')")
+DEALER_PHONE = (f"CASE WHEN length({DIGITS}) > {customers.LOCAL_NUMBER_LENGTH} "
+                f"AND {DIGITS} LIKE '{customers.COUNTRY_CODE}%' "
+                f"THEN substr({DIGITS}, {len(customers.COUNTRY_CODE) + 1}) ELSE {DIGITS} END")
+
+# kind -> (FTS table, source table, indexed columns as SQL over the source row
+# ({} or {0} stands for the row alias), result columns; the second is the name)
+SOURCES = {
+    'items': ('search_items', 'items', ['{}.item', '{}.batch_no'],
+              ['id', 'item', 'batch_no', 'quantity', 'expiry_date']),
+    'dealers': ('search_dealers', 'dealers', ['{}.name', '{}.phone_key'],
+                ['id', 'name', 'phone_no', 'address']),
+    'customers': ('search_customers', 'customers', ['{}.name', '{}.phone_key'],
+                  ['id', 'name', 'phone_no', 'address']),
+}
+
+# Response field names that differ from the column
+FIELD_NAMES = {'item': 'name'}
+
+
+def create_statements(kind, columns=None):
+    fts, table, source_columns, _ = SOURCES[kind]
+    columns = columns or source_columns
+    names = ', '.join(f'c{index}' for index in range(len(columns)))
+    new = ', '.join(column.format('NEW') for column in columns)
+    old = ', '.join(column.format('OLD') for column in columns)
+    changed = ' OR '.join(f"{column.format('OLD')} IS NOT {column.format('NEW')}" for column in columns)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({names}, content='', prefix='{PREFIX_LENGTHS}')",
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_search_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO {fts} (rowid, {names}) VALUES (NEW.id, {new});
+        END
+        ''',
+        # A contentless table deletes by being given the indexed values again
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_search_delete AFTER DELETE ON {table}
+        BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', OLD.id, {old});
+        END
+        ''',
+        # Only when an indexed value changes, not on every stock update
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_search_update AFTER UPDATE ON {table}
+        WHEN {changed}
+        BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', OLD.id, {old});
+            INSERT INTO {fts} (rowid, {names}) VALUES (NEW.id, {new});
+        END
+        ''',
+        f'''
+        INSERT INTO {fts} (rowid, {names})
+        SELECT t.id, {', '.join(column.format('t') for column in columns)} FROM {table} t
+        ''',
+    ]
+
+
+# As applied by migration 8
+CREATE_SEARCH = (create_statements('items') + create_statements('dealers', ['{}.name', DEALER_PHONE])
+                 + create_statements('customers'))
+
+ADD_DEALER_PHONE_KEY = [
+    'ALTER TABLE dealers ADD COLUMN phone_key TEXT',
+]
+
+# Index dealers by phone_key instead; a contentless table cannot have rows
+# deleted with values other than those indexed, so it is rebuilt
+REINDEX_DEALERS = [
+    'DROP TRIGGER IF EXISTS trg_dealers_search_insert',
+    'DROP TRIGGER IF EXISTS trg_dealers_search_delete',
+    'DROP TRIGGER IF EXISTS trg_dealers_search_update',
+    'DROP TABLE IF EXISTS search_dealers',
+] + create_statements('dealers')
+
+
+def fill_dealer_phone_key(cursor):
+    cursor.execute('SELECT id, phone_no FROM dealers')
+    cursor.executemany('UPDATE dealers SET phone_key = ? WHERE id = ?',
+                       [(customers.normalize_phone(phone_no), id) for id, phone_no in cursor.fetchall()])
+
+
+def query_words(text):
+    return re.findall(r'\w+', text or '')
+
+
+def match_expression(words):
+    # Every word must match, each as a prefix: 'para 50' -> "para"* "50"*.
+    # Words are quoted so FTS5 operators in the input are searched literally.
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_query(kind):
+    fts, table, _, fields = SOURCES[kind]
+    return f'''
+        SELECT {', '.join(f't.{field}' for field in fields)}
+        FROM (SELECT rowid FROM {fts} WHERE {fts} MATCH ? ORDER BY rowid DESC LIMIT {CANDIDATES}) m
+        JOIN {table} t ON t.id = m.rowid
+        ORDER BY lower(t.{fields[1]}) = ? DESC, instr(lower(t.{fields[1]}), ?) = 1 DESC,
+                 length(t.{fields[1]}), t.id DESC
+        LIMIT ?
+    '''
+
+
+def search(cursor, words, kinds, limit=DEFAULT_LIMIT):
+    # {kind: [row dict, ...]} best match first
+    text = ' '.join(words).lower()
+    results = {}
+    for kind in kinds:
+        fields = SOURCES[kind][3]
+        cursor.execute(search_query(kind), (match_expression(words), text, text, limit))
+        results[kind] = [dict(zip((FIELD_NAMES.get(field, field) for field in fields), row))
+                         for row in cursor.fetchall()]
+    return results
@@ -0,0 +1,110 @@
+import json
+import logging
+import sqlite3
+import threading
+
+from flask import Response, jsonify, request
+
+import db
+
+# Rows fetched from the cursor per round trip while streaming
+STREAM_BATCH_SIZE = 500
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# A streamed response holds its own database connection until the client
+# has read all of it, so slow clients never take connections from the pool;
+# past this many at once a stream is refused with 503
+MAX_STREAMS = 16
+_streams = threading.BoundedSemaphore(MAX_STREAMS)
+
+
+def wants_stream():
+    # Streaming is opt-in: ?stream=1 or an NDJSON Accept header
+    return (request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+            or wants_ndjson())
+
+
+def wants_ndjson():
+    return request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+def iter_rows(cursor, batch_size=STREAM_BATCH_SIZE):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def query_items(path, query, params, make_item):
+    # Lazily run ``query`` against the database at ``path`` and yield one
+    # JSON-able object per row. The status line has already been sent by the
+    # time this runs, so errors are logged and end the stream early.
+    conn = db.open_connection(path, read_only=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        for row in iter_rows(cursor):
+            yield make_item(row)
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error while streaming: {e}")
+        raise
+    finally:
+        conn.close()
+
+
+def json_array(items, batch_size=STREAM_BATCH_SIZE):
+    # Yield a JSON array in chunks of ``batch_size`` elements
+    yield '['
+    chunk = []
+    first = True
+    for item in items:
+        chunk.append(json.dumps(item))
+        if len(chunk) >= batch_size:
+            yield ('' if first else ',') + ','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+    yield ']'
+
+
+def json_object(fields):
+    # ``fields`` is a list of (name, value) where a generator value is
+    # streamed as an array and anything else is serialized as-is
+    yield '{'
+    for index, (name, value) in enumerate(fields):
+        yield ('' if index == 0 else ',') + json.dumps(name) + ':'
+        if hasattr(value, '__next__'):
+            yield from json_array(value)
+        else:
+            yield json.dumps(value)
+    yield '}'
+
+
+def ndjson_lines(items, batch_size=STREAM_BATCH_SIZE):
+    chunk = []
+    for item in items:
+        chunk.append(json.dumps(item) + '\n')
+        if len(chunk) >= batch_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def stream_response(chunks, mimetype='application/json'):
+    # A streamed Response, or 503 while MAX_STREAMS are in progress. The
+    # slot is given back when the server closes the response.
+    if not _streams.acquire(blocking=False):
+        return jsonify({'message': 'Too many streaming requests, try again later'}), 503
+    response = Response(chunks, mimetype=mimetype)
+    response.call_on_close(_streams.release)
+    return response
+
+
+def stream_list(items):
+    # Stream ``items`` as a JSON array, or as NDJSON when the client asks
+    if wants_ndjson():
+        return stream_response(ndjson_lines(items), NDJSON_MIMETYPE)
+    return stream_response(json_array(items))
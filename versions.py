@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+# Release metadata is read from files next to auth.py, as written by
+# release_github.py: ``release`` for the stable channel and
+# ``release.<channel>`` for any other, each a JSON object with the version
+# and url so both change together. Without one, the older pair of files
+# ``version`` and ``url`` (``version.<channel>`` / ``url.<channel>``) is
+# read. An optional ``min_version`` (or ``min_version.<channel>``) marks
+# older clients as required to update.
+STABLE_CHANNEL = 'stable'
+POLL_INTERVAL = 5
+
+Release = namedtuple('Release', ['version', 'url', 'min_version'])
+
+
+def parse_version(version):
+    # 'v0.0.020' -> (0, 0, 20); anything unparsable sorts first
+    try:
+        return tuple(int(part) for part in re.findall(r'\d+', version))
+    except (TypeError, ValueError):
+        return ()
+
+
+def channel_file(name, channel):
+    return name if channel == STABLE_CHANNEL else f'{name}.{channel}'
+
+
+class VersionRegistry:
+    """In-memory copy of the release files, reloaded when they change.
+
+    A background thread polls the files' mtimes; requests only read the
+    current dict of releases, which is replaced as a whole on reload.
+    """
+
+    def __init__(self, directory='.', poll_interval=POLL_INTERVAL):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self._releases = {}
+        self._signature = None
+        self._lock = threading.Lock()
+        self._thread_pid = None
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.directory, name), 'r') as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _read_release(self, channel):
+        # (version, url) of ``channel``, None for whichever is missing
+        text = self._read(channel_file('release', channel))
+        if text is None:
+            return self._read(channel_file('version', channel)), self._read(channel_file('url', channel))
+        try:
+            release = json.loads(text)
+            return release.get('version'), release.get('url')
+        except (ValueError, AttributeError):
+            logging.error(f"Invalid release file for channel '{channel}'")
+            return None, None
+
+    def _release_files(self):
+        names = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if re.fullmatch(r'(release|version|url|min_version)(\.\w+)?', entry.name):
+                    stat = entry.stat()
+                    names.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        return tuple(sorted(names))
+
+    def reload_if_changed(self):
+        with self._lock:
+            signature = self._release_files()
+            if signature == self._signature:
+                return False
+            channels = {STABLE_CHANNEL}
+            channels.update(name.split('.', 1)[1] for name, _, _ in signature
+                            if name.startswith(('release.', 'version.')))
+            releases = {}
+            for channel in channels:
+                version, url = self._read_release(channel)
+                if version is None or url is None:
+                    continue
+                releases[channel] = Release(
+                    version=f'v{version}', url=url + '/app-release.apk',
+                    min_version=self._read(channel_file('min_version', channel)))
+            self._releases = releases
+            self._signature = signature
+        logging.info(f"Loaded release channels: {', '.join(sorted(releases))}")
+        return True
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.reload_if_changed()
+            except OSError as e:
+                logging.error(f"Failed to reload release files: {e}")
+
+    def _ensure_started(self):
+        # The poller is started lazily, and again in each forked worker
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        self.reload_if_changed()
+        threading.Thread(target=self._poll, name='version-registry', daemon=True).start()
+
+    def get(self, channel=STABLE_CHANNEL):
+        self._ensure_started()
+        return self._releases.get(channel)
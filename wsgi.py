@@ -0,0 +1,12 @@
+from auth import config_from_env, create_app
+
+# WSGI entry point, e.g.
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#   waitress-serve --threads 8 wsgi:app
+#
+# The maintenance jobs in scheduler.py (key pruning, checkpoints, backups, the
+# rollup rebuild, ...) do not run unless asked for: set SVP_SCHEDULER=1 to
+# run them in the API processes, or run `python scheduler.py serve` next to
+# the server. Scheduled notifications are also sent when clients read
+# notifications, so they arrive either way.
+app = create_app(config_from_env())